@@ -0,0 +1,267 @@
+import asyncio
+import heapq
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumFlushPolicy:
+    """Адаптивное окно ожидания частей альбома.
+
+    Части одного альбома обычно приходят с разницей в миллисекунды, поэтому
+    окно тишины подстраивается под наблюдаемые интервалы (среднее + 4
+    отклонения, как RTO в TCP) и ограничено сверху общим max_wait.
+    """
+
+    def __init__(self, min_quiet: float = 0.25, max_quiet: float = 5.0,
+                 max_wait: float = 10.0, initial_quiet: float = 1.0,
+                 alpha: float = 0.125, beta: float = 0.25,
+                 max_tracked: int = 1000):
+        self.min_quiet = min_quiet
+        self.max_quiet = max_quiet
+        self.max_wait = max_wait
+        self.initial_quiet = initial_quiet
+        self.alpha = alpha
+        self.beta = beta
+        self.max_tracked = max_tracked
+        self.mean: Optional[float] = None
+        self.dev = 0.0
+        self._flushed: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def observe(self, gap: float):
+        if gap < 0:
+            return
+        gap = min(gap, self.max_quiet)
+        if self.mean is None:
+            self.mean = gap
+            self.dev = gap / 2
+            return
+        self.dev += self.beta * (abs(gap - self.mean) - self.dev)
+        self.mean += self.alpha * (gap - self.mean)
+
+    @property
+    def quiet(self) -> float:
+        if self.mean is None:
+            return self.initial_quiet
+        return min(max(self.mean + 4 * self.dev, self.min_quiet),
+                   self.max_quiet)
+
+    def delay(self, first_seen: float, now: float) -> float:
+        return max(0.0, min(self.quiet, first_seen + self.max_wait - now))
+
+    def flushed(self, key: Hashable, last_seen: float):
+        self._flushed[key] = last_seen
+        self._flushed.move_to_end(key)
+        if len(self._flushed) > self.max_tracked:
+            self._flushed.popitem(last=False)
+
+    def arrived_late(self, key: Hashable, now: float) -> bool:
+        # Часть пришла после отправки альбома — окно было слишком коротким
+        last_seen = self._flushed.pop(key, None)
+        if last_seen is None:
+            return False
+        self.observe(now - last_seen)
+        return True
+
+
+class FixedFlushPolicy(AlbumFlushPolicy):
+    """Постоянное окно ожидания без подстройки."""
+
+    def __init__(self, quiet: float, max_wait: float):
+        super().__init__(min_quiet=quiet, max_quiet=quiet,
+                         max_wait=max_wait, initial_quiet=quiet)
+
+    def observe(self, gap: float):
+        pass
+
+    def flushed(self, key: Hashable, last_seen: float):
+        pass
+
+    def arrived_late(self, key: Hashable, now: float) -> bool:
+        return False
+
+
+class PendingBatch:
+    __slots__ = ("items", "first_seen", "last_seen", "seq")
+
+    def __init__(self, now: float):
+        self.items: List = []
+        self.first_seen = now
+        self.last_seen = now
+        self.seq = 0
+
+
+class BatchScheduler:
+    """Буфер пачек с одной фоновой задачей вместо таймера на пачку.
+
+    Пачка - сообщения одного чата с общим ключом: части альбома, тексты
+    или подтверждения одного отправителя. label называет пачку в логах.
+    Сроки отправки хранятся в куче (O(log n) на обновление, устаревшие
+    записи пропускаются при извлечении). Жёсткие лимиты на число
+    сообщений в буфере на чат и в целом: при превышении раньше срока
+    отправляется самая старая пачка чата или пачка с ближайшим сроком.
+    """
+
+    def __init__(self, policy: AlbumFlushPolicy,
+                 on_flush: Callable[[List], None],
+                 group_limit: int = 10, max_per_chat: int = 100,
+                 max_total: int = 10000, label: str = "альбом"):
+        self.policy = policy
+        self.label = label
+        self.on_flush = on_flush
+        self.group_limit = group_limit
+        self.max_per_chat = max_per_chat
+        self.max_total = max_total
+        self.buffer: Dict[int, Dict[Hashable, PendingBatch]] = {}
+        self.chat_counts: Dict[int, int] = {}
+        self.total = 0
+        self._heap: List[Tuple[float, int, int, Hashable]] = []
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(groups) for groups in self.buffer.values())
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def clear(self):
+        self.buffer.clear()
+        self.chat_counts.clear()
+        self.total = 0
+        self._heap.clear()
+
+    def flush_all(self):
+        # Остановка: всё накопленное отправляется, не дожидаясь сроков
+        for chat_id, groups in list(self.buffer.items()):
+            for key in list(groups):
+                self.flush(chat_id, key)
+        self._heap.clear()
+
+    def add(self, chat_id: int, key: Hashable, item):
+        now = asyncio.get_running_loop().time()
+        groups = self.buffer.setdefault(chat_id, {})
+        batch = groups.get(key)
+        if batch is None:
+            if self.policy.arrived_late((chat_id, key), now):
+                logger.info(
+                    f"Сообщение пришло после отправки ({self.label} "
+                    f"{key}), окно ожидания теперь "
+                    f"{self.policy.quiet:.2f} сек.")
+            batch = groups[key] = PendingBatch(now)
+        else:
+            self.policy.observe(now - batch.last_seen)
+            batch.last_seen = now
+        batch.items.append(item)
+        self.chat_counts[chat_id] = self.chat_counts.get(chat_id, 0) + 1
+        self.total += 1
+
+        # Полную пачку отправляем сразу, не дожидаясь срока
+        if len(batch.items) >= self.group_limit:
+            self.flush(chat_id, key)
+        else:
+            self._schedule(chat_id, key, batch,
+                           now + self.policy.delay(batch.first_seen, now))
+        self._enforce_caps(chat_id)
+
+    def flush(self, chat_id: int, key: Hashable):
+        groups = self.buffer.get(chat_id)
+        batch = groups.pop(key, None) if groups else None
+        if batch is None:
+            return
+        if not groups:
+            del self.buffer[chat_id]
+        count = len(batch.items)
+        self.total -= count
+        self.chat_counts[chat_id] -= count
+        if not self.chat_counts[chat_id]:
+            del self.chat_counts[chat_id]
+        self.policy.flushed((chat_id, key), batch.last_seen)
+        self.on_flush(batch.items)
+
+    def _schedule(self, chat_id: int, key: Hashable,
+                  batch: PendingBatch, deadline: float):
+        self._seq += 1
+        batch.seq = self._seq
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (deadline, self._seq, chat_id, key))
+        if len(self._heap) > 2 * self.total + 64:
+            self._compact()
+        if self._wakeup and (earliest is None or deadline < earliest):
+            self._wakeup.set()
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._valid(entry)]
+        heapq.heapify(self._heap)
+
+    def _valid(self, entry: Tuple[float, int, int, Hashable]) -> bool:
+        _, seq, chat_id, key = entry
+        batch = self.buffer.get(chat_id, {}).get(key)
+        return batch is not None and batch.seq == seq
+
+    def _enforce_caps(self, chat_id: int):
+        while self.chat_counts.get(chat_id, 0) > self.max_per_chat:
+            oldest = next(iter(self.buffer[chat_id]))
+            logger.warning(f"Буфер чата {chat_id} переполнен, "
+                           f"{self.label} {oldest} отправляется досрочно")
+            self.flush(chat_id, oldest)
+        while self.total > self.max_total and self._heap:
+            entry = heapq.heappop(self._heap)
+            if self._valid(entry):
+                logger.warning(f"Буфер переполнен, {self.label} "
+                               f"{entry[3]} отправляется досрочно")
+                self.flush(entry[2], entry[3])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if self._valid(entry):
+                    self.flush(entry[2], entry[3])
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def plan_groups(items: Sequence, limit: int = 10) -> List[List]:
+    """Раскладывает файлы альбома на допустимые для sendMediaGroup группы.
+
+    Фото и видео можно смешивать, документы отправляются только с
+    документами. Каждый класс делится на наименьшее число групп почти
+    равного размера (11 файлов - это 6 + 5, а не 10 + 1), чтобы не
+    оставалось одиночных файлов. Внутри класса порядок сохраняется,
+    группы идут в порядке появления их первого файла.
+    """
+    classes: Dict[bool, List] = {}
+    for item in items:
+        classes.setdefault(bool(item.is_document), []).append(item)
+    groups = []
+    for members in classes.values():
+        count = -(-len(members) // limit)
+        size, extra = divmod(len(members), count)
+        start = 0
+        for index in range(count):
+            end = start + size + (1 if index < extra else 0)
+            groups.append(members[start:end])
+            start = end
+    order = {id(item): position for position, item in enumerate(items)}
+    groups.sort(key=lambda group: order[id(group[0])])
+    return groups
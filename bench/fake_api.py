@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+TOKEN_RE = re.compile(r"bench-[a-z]+-\d+")
+
+
+class FakeBotAPI:
+    """Локальная замена Bot API для нагрузочных прогонов.
+
+    Отдаёт обновления через getUpdates, отвечает на send* с заданной
+    задержкой и с заданной вероятностью возвращает 429 (RetryAfter).
+    Каждый запрос к целевым чатам проверяется на маркеры bench-*,
+    чтобы посчитать сквозную задержку от обновления до отправки.
+    """
+
+    def __init__(self, latency: Optional[Dict[str, float]] = None,
+                 default_latency: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1,
+                 seed: int = 1):
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+        self.retry_afters = 0
+        self.on_token: Optional[Callable[[str, float], None]] = None
+        self._updates: List[dict] = []
+        self._has_updates = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    def push_update(self, update: dict):
+        self._updates.append(update)
+        self._has_updates.set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _read(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        data = await request.post()
+        return {key: value for key, value in data.items()
+                if isinstance(value, str)}
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await self._read(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(data))
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True,
+                             "first_name": "bench", "username": "bench"})
+        if not method.startswith(("send", "copy", "forward", "edit")):
+            return self._ok(True)
+
+        delay = self.latency.get(method, self.default_latency)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.retry_after_rate and \
+                self.random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after "
+                               f"{self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        chat_id = int(data.get("chat_id", 0))
+        if chat_id < 0 and self.on_token:
+            now = time.perf_counter()
+            for token in set(TOKEN_RE.findall(json.dumps(data))):
+                self.on_token(token, now)
+
+        if method == "sendMediaGroup":
+            media = json.loads(data.get("media", "[]"))
+            return self._ok([self._message(chat_id) for _ in media])
+        return self._ok(self._message(chat_id, data.get("text")))
+
+    async def _get_updates(self, data: dict) -> List[dict]:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        timeout = min(float(data.get("timeout") or 0), 1.0)
+        self._updates = [update for update in self._updates
+                         if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def _message(self, chat_id: int, text: Optional[str] = None) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id,
+                     "type": "supergroup" if chat_id < 0 else "private"},
+        }
+        if text:
+            message["text"] = text
+        return message
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
@@ -0,0 +1,455 @@
+"""Нагрузочный прогон бота против локального фальшивого Bot API.
+
+Запуск из корня репозитория, сеть не нужна:
+
+    python bench/run.py --events 500 --mode polling
+    python bench/run.py --mode webhook --media-latency 0.05 --json out.json
+    python bench/run.py --max-p95-ms 500 --baseline base.json
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Функции, для которых считается память, выделенная внутри них
+MEMORY_FUNCTIONS = ("handle_media", "handle_edit", "forward_file",
+                    "send_album", "deliver")
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_api import FakeBotAPI  # noqa: E402
+from updates import DEFAULT_MIX, UpdateGenerator, parse_mix  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(max(values, default=0.0) * 1000, 2),
+    }
+
+
+def configure_env(args: argparse.Namespace, data_dir: str):
+    # Настройки читаются main.py при импорте, поэтому задаются заранее.
+    # Явно заданные переменные окружения имеют приоритет.
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("CHAT_ID", "-1001000000001")
+    # Хранилища всегда во временном каталоге прогона, чтобы нагрузочный
+    # прогон не трогал рабочие данные бота
+    for name, filename in (("OUTBOX_PATH", "outbox.sqlite3"),
+                           ("DEAD_LETTER_PATH", "dead_letters.sqlite3"),
+                           ("DEDUP_PATH", "dedup.sqlite3"),
+                           ("FORWARD_INDEX_PATH", "forward_index.sqlite3")):
+        os.environ[name] = os.path.join(data_dir, filename)
+    os.environ.setdefault("RATE_GLOBAL_PER_SEC", "1000000")
+    os.environ.setdefault("RATE_GROUP_PER_MIN", "1000000")
+    os.environ.setdefault("RATE_PRIVATE_PER_SEC", "1000000")
+    # Фальшивый API держит getUpdates не дольше секунды
+    os.environ.setdefault("POLLING_TIMEOUT_SEC", "1")
+    os.environ["BOT_MODE"] = "webhook" if args.mode == "webhook" \
+        else "polling"
+    os.environ["WEBHOOK_BASE_URL"] = ""
+    os.environ.setdefault("WEBHOOK_SECRET", "bench")
+    os.environ["WEBHOOK_HOST"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(free_port())
+    # Бот ходит в фальшивый API так же, как в свой сервер telegram-bot-api
+    args.api_port = free_port()
+    os.environ["BOT_API_URL"] = f"http://127.0.0.1:{args.api_port}"
+
+
+class Timings:
+    """Сырые замеры: время функций и сквозная задержка событий."""
+
+    def __init__(self):
+        self.functions: Dict[str, List[float]] = {}
+        self.started: Dict[str, float] = {}
+        self.kinds: Dict[str, str] = {}
+        self.delivered: Dict[str, float] = {}
+        self.handled = 0
+        self.done = asyncio.Event()
+
+    def record(self, name: str, seconds: float):
+        self.functions.setdefault(name, []).append(seconds)
+
+    def on_token(self, token: str, now: float):
+        if token in self.started and token not in self.delivered:
+            self.delivered[token] = now
+            if len(self.delivered) == len(self.started):
+                self.done.set()
+
+    def timed(self, name: str,
+              func: Callable[..., Awaitable[Any]]) -> Callable:
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return wrapper
+
+
+def code_ranges(main) -> Dict[str, Tuple[str, int, int]]:
+    # Файл и строки каждой функции - до того, как instrument их обернёт
+    ranges = {}
+    for name in MEMORY_FUNCTIONS:
+        func = getattr(main, name)
+        lines, first = inspect.getsourcelines(func)
+        ranges[name] = (inspect.getsourcefile(func), first,
+                        first + len(lines) - 1)
+    return ranges
+
+
+def memory_by_function(snapshot: tracemalloc.Snapshot,
+                       ranges: Dict[str, Tuple[str, int, int]]
+                       ) -> Dict[str, float]:
+    # Живые блоки, в стеке выделения которых есть функция: вложенные
+    # вызовы засчитываются каждой функции цепочки
+    sizes = dict.fromkeys(ranges, 0)
+    for trace in snapshot.traces:
+        for name, (filename, first, last) in ranges.items():
+            if any(frame.filename == filename and first <= frame.lineno <= last
+                   for frame in trace.traceback):
+                sizes[name] += trace.size
+    return {name: round(size / 1024, 1) for name, size in sizes.items()}
+
+
+def instrument(main, timings: Timings):
+    # forward_file и send_album ищутся как глобальные имена при вызове
+    main.forward_file = timings.timed("forward_file", main.forward_file)
+    main.send_album = timings.timed("send_album", main.send_album)
+
+    async def handler_timer(handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            timings.handled += 1
+            timings.record(getattr(callback, "__name__", "unknown"),
+                           time.perf_counter() - start)
+
+    main.dp.message.middleware(handler_timer)
+    main.dp.edited_message.middleware(handler_timer)
+
+
+async def inject(events, push: Callable[[dict], Awaitable[None]],
+                 timings: Timings, rate: float):
+    interval = 1 / rate if rate else 0
+    start = time.perf_counter()
+    for number, event in enumerate(events):
+        if interval:
+            delay = start + number * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        timings.started[event.token] = time.perf_counter()
+        timings.kinds[event.token] = event.kind
+        for update in event.updates:
+            await push(update)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    import main
+    from aiogram.types import Update
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    latency = {"sendMessage": args.text_latency}
+    for method in ("sendPhoto", "sendVideo", "sendDocument",
+                   "sendMediaGroup"):
+        latency[method] = args.media_latency
+    api = FakeBotAPI(latency=latency, retry_after_rate=args.retry_after_rate,
+                     retry_after=args.retry_after, seed=args.seed)
+    timings = Timings()
+    api.on_token = timings.on_token
+    await api.start(port=args.api_port)
+
+    generator = UpdateGenerator(senders=args.senders,
+                                max_album=args.max_album, seed=args.seed)
+    events = generator.generate(args.events, parse_mix(args.mix))
+    ranges = code_ranges(main)
+    instrument(main, timings)
+
+    bot = main.make_bot()
+    runner: Optional[asyncio.Task] = None
+    client = None
+    stop = asyncio.Event()
+
+    if args.mode == "polling":
+        async def push(update: dict):
+            api.push_update(update)
+
+        runner = asyncio.create_task(main.run_polling(bot, stop))
+    elif args.mode == "webhook":
+        from aiohttp import ClientSession
+        client = ClientSession()
+        url = (f"http://{main.WEBHOOK_HOST}:{main.WEBHOOK_PORT}"
+               f"{main.WEBHOOK_PATH}")
+        headers = {}
+        if main.WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = main.WEBHOOK_SECRET
+
+        async def push(update: dict):
+            async with client.post(url, json=update, headers=headers) as r:
+                r.raise_for_status()
+
+        runner = asyncio.create_task(main.run_webhook(bot, stop))
+    else:
+        background = set()
+
+        async def push(update: dict):
+            task = asyncio.create_task(main.dp.feed_update(
+                bot, Update.model_validate(update, context={"bot": bot})))
+            background.add(task)
+            task.add_done_callback(background.discard)
+
+        await main.dp.emit_startup(bot=bot)
+
+    await wait_ready(main)
+    tracemalloc.start(args.trace_frames if args.memory_by_function else 1)
+    start = time.perf_counter()
+    await inject(events, push, timings, args.rate)
+    snapshot = None
+    if args.memory_by_function:
+        # Снимок, когда все обновления прошли обработчики, а буферы и
+        # очередь доставки заполнены сильнее всего
+        updates = sum(len(event.updates) for event in events)
+        deadline = time.perf_counter() + args.timeout
+        while timings.handled < updates and \
+                time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        snapshot = tracemalloc.take_snapshot()
+    try:
+        await asyncio.wait_for(timings.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Ответы пользователям отправляются после доставки, дожидаемся их
+    try:
+        await asyncio.wait_for(main.delivery_queue.join(), 5)
+    except asyncio.TimeoutError:
+        pass
+
+    if runner is not None:
+        stop.set()
+        await runner
+    else:
+        await main.dp.emit_shutdown(bot=bot)
+    if client is not None:
+        await client.close()
+    await bot.session.close()
+    await api.stop()
+
+    result = report(args, events, timings, api, elapsed, peak)
+    if snapshot is not None:
+        result["memory_by_function_kb"] = memory_by_function(
+            snapshot, ranges)
+    return result
+
+
+async def wait_ready(main, timeout: float = 10.0):
+    deadline = time.perf_counter() + timeout
+    while not main.is_ready():
+        if time.perf_counter() > deadline:
+            raise RuntimeError("Бот не запустился")
+        await asyncio.sleep(0.01)
+    if main.BOT_MODE == "webhook":
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(
+                    main.WEBHOOK_HOST, main.WEBHOOK_PORT)
+                writer.close()
+                return
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.01)
+
+
+def report(args, events, timings: Timings, api: FakeBotAPI,
+           elapsed: float, peak: int) -> Dict[str, Any]:
+    latency: Dict[str, List[float]] = {}
+    for token, finished in timings.delivered.items():
+        latency.setdefault(timings.kinds[token], []).append(
+            finished - timings.started[token])
+    overall = [value for values in latency.values() for value in values]
+    updates = sum(len(event.updates) for event in events)
+    result = {
+        "mode": args.mode,
+        "events": len(events),
+        "updates": updates,
+        "delivered": len(timings.delivered),
+        "lost": len(events) - len(timings.delivered),
+        "elapsed_sec": round(elapsed, 3),
+        "updates_per_sec": round(updates / elapsed, 1) if elapsed else 0,
+        "retry_after_responses": api.retry_afters,
+        "api_calls": dict(sorted(api.calls.items())),
+        "end_to_end": {kind: summarize(values)
+                       for kind, values in sorted(latency.items())},
+        "end_to_end_all": summarize(overall),
+        "functions": {name: summarize(values)
+                      for name, values in sorted(timings.functions.items())},
+        "memory": {"tracemalloc_peak_kb": round(peak / 1024, 1)},
+    }
+    if resource is not None:
+        result["memory"]["max_rss_kb"] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"Режим: {result['mode']}, событий: {result['events']}, "
+          f"обновлений: {result['updates']}, "
+          f"доставлено: {result['delivered']}, "
+          f"потеряно: {result['lost']}")
+    print(f"Время: {result['elapsed_sec']} сек., "
+          f"{result['updates_per_sec']} обновлений/сек., "
+          f"ответов 429: {result['retry_after_responses']}")
+    for title, section in (("Сквозная задержка", "end_to_end"),
+                           ("Функции", "functions")):
+        print(f"\n{title}:")
+        print(f"  {'':<14}{'n':>7}{'p50 мс':>10}{'p95 мс':>10}"
+              f"{'p99 мс':>10}{'max мс':>10}")
+        for name, stats in result[section].items():
+            print(f"  {name:<14}{stats['count']:>7}{stats['p50_ms']:>10}"
+                  f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+                  f"{stats['max_ms']:>10}")
+    memory = ", ".join(f"{key}={value}"
+                       for key, value in result["memory"].items())
+    print(f"\nПамять: {memory}")
+    if "memory_by_function_kb" in result:
+        print("Память по функциям (КБ после обработки всех обновлений):")
+        for name, size in result["memory_by_function_kb"].items():
+            print(f"  {name:<14}{size:>10}")
+
+
+def check(args: argparse.Namespace, result: Dict[str, Any]) -> List[str]:
+    # Нарушенные пороги и ухудшения относительно опорного прогона
+    failures = []
+    p95 = result["end_to_end_all"]["p95_ms"]
+    rate = result["updates_per_sec"]
+    if result["lost"]:
+        failures.append(f"не доставлено событий: {result['lost']}")
+    if args.memory_by_function:
+        # Глубокая трассировка памяти замедляет прогон, время не сравнить
+        return failures
+    if args.max_p95_ms and p95 > args.max_p95_ms:
+        failures.append(f"p95 {p95} мс больше {args.max_p95_ms} мс")
+    if args.min_updates_per_sec and rate < args.min_updates_per_sec:
+        failures.append(f"{rate} обновлений/сек. меньше "
+                        f"{args.min_updates_per_sec}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        allowed = 1 + args.tolerance
+        base_p95 = baseline["end_to_end_all"]["p95_ms"]
+        if base_p95 and p95 > base_p95 * allowed:
+            failures.append(f"p95 {p95} мс хуже опорного {base_p95} мс")
+        base_rate = baseline["updates_per_sec"]
+        if rate * allowed < base_rate:
+            failures.append(f"{rate} обновлений/сек. хуже опорных "
+                            f"{base_rate}")
+        base_peak = baseline["memory"]["tracemalloc_peak_kb"]
+        peak = result["memory"]["tracemalloc_peak_kb"]
+        if base_peak and peak > base_peak * allowed:
+            failures.append(f"пик памяти {peak} КБ больше опорного "
+                            f"{base_peak} КБ")
+    return failures
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--mode", choices=("polling", "webhook", "feed"),
+                        default="polling")
+    parser.add_argument(
+        "--mix", default=",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()),
+        help="доли событий, например text=4,file=3,album=2,edit=1")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="событий в секунду (0 - без паузы)")
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--max-album", type=int, default=10)
+    parser.add_argument("--text-latency", type=float, default=0.0,
+                        help="задержка sendMessage, сек.")
+    parser.add_argument("--media-latency", type=float, default=0.0,
+                        help="задержка отправки файлов и альбомов, сек.")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0,
+                        help="доля ответов 429 на отправку")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="сколько ждать доставки всех событий, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать результат в файл")
+    parser.add_argument("--max-p95-ms", type=float, default=0,
+                        help="порог сквозной задержки p95, мс")
+    parser.add_argument("--min-updates-per-sec", type=float, default=0,
+                        help="порог пропускной способности")
+    parser.add_argument("--baseline",
+                        help="JSON опорного прогона (--json) для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="допустимое ухудшение относительно опорного")
+    parser.add_argument("--memory-by-function", action="store_true",
+                        help="посчитать память по функциям (медленнее, "
+                             "пороги времени не проверяются)")
+    parser.add_argument("--trace-frames", type=int, default=16,
+                        help="глубина стека tracemalloc для "
+                             "--memory-by-function")
+    parser.add_argument("--verbose", action="store_true",
+                        help="не глушить логи бота")
+    return parser.parse_args(argv)
+
+
+def cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    data_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    try:
+        configure_env(args, data_dir)
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    # Ненулевой код при потерях или нарушенных порогах - удобно для CI
+    failures = check(args, result)
+    for failure in failures:
+        print(f"ОШИБКА: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
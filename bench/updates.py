@@ -0,0 +1,104 @@
+import itertools
+import random
+import time
+from typing import Dict, List, NamedTuple
+
+KINDS = ("text", "file", "album", "edit")
+DEFAULT_MIX = {"text": 4, "file": 3, "album": 2, "edit": 1}
+
+
+class Event(NamedTuple):
+    # Одно действие пользователя: маркер попадает в текст или file_id,
+    # по нему фальшивый API узнаёт, что событие доставлено
+    kind: str
+    token: str
+    updates: List[dict]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Неизвестный тип события: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class UpdateGenerator:
+    """Синтетические обновления Telegram: тексты, файлы, альбомы, правки."""
+
+    def __init__(self, senders: int = 10, max_album: int = 10,
+                 seed: int = 1):
+        self.senders = senders
+        self.max_album = max_album
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._counters = {kind: itertools.count(1) for kind in KINDS}
+        self._media_groups = itertools.count(1)
+
+    def generate(self, events: int,
+                 mix: Dict[str, float] = DEFAULT_MIX) -> List[Event]:
+        kinds = [kind for kind in mix if mix[kind] > 0]
+        weights = [mix[kind] for kind in kinds]
+        return [self.event(kind) for kind in
+                self.random.choices(kinds, weights, k=events)]
+
+    def event(self, kind: str) -> Event:
+        token = f"bench-{kind}-{next(self._counters[kind])}"
+        sender = self.random.randrange(self.senders)
+        if kind == "text":
+            updates = [self._update("message", self._message(
+                sender, text=f"{token} сообщение для замера"))]
+        elif kind == "edit":
+            message = self._message(
+                sender, text=f"{token} исправленный текст")
+            message["edit_date"] = message["date"]
+            updates = [self._update("edited_message", message)]
+        elif kind == "file":
+            updates = [self._update("message", self._message(
+                sender, **self._file(token)))]
+        else:
+            media_group_id = str(next(self._media_groups))
+            size = self.random.randint(2, self.max_album)
+            updates = []
+            for index in range(size):
+                fields = self._file(f"{token}x{index}")
+                if index == 0:
+                    fields["caption"] = "альбом"
+                updates.append(self._update("message", self._message(
+                    sender, media_group_id=media_group_id, **fields)))
+        return Event(kind, token, updates)
+
+    def _update(self, field: str, message: dict) -> dict:
+        return {"update_id": next(self._update_ids), field: message}
+
+    def _message(self, sender: int, **fields) -> dict:
+        user_id = 100000 + sender
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False,
+                     "first_name": f"Отправитель {sender}"},
+            **fields,
+        }
+
+    def _file(self, file_id: str) -> dict:
+        size = self.random.randint(100_000, 20_000_000)
+        kind = self.random.choice(("photo", "video", "document"))
+        if kind == "photo":
+            return {"photo": [{
+                "file_id": file_id, "file_unique_id": f"u-{file_id}",
+                "width": 1280, "height": 960, "file_size": size}]}
+        if kind == "video":
+            return {"video": {
+                "file_id": file_id, "file_unique_id": f"u-{file_id}",
+                "width": 1280, "height": 720, "duration": 10,
+                "file_size": size}}
+        return {"document": {
+            "file_id": file_id, "file_unique_id": f"u-{file_id}",
+            "file_name": self.random.choice(("photo.jpg", "clip.mp4")),
+            "file_size": size}}
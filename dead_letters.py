@@ -0,0 +1,112 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional
+
+from outbox import COLUMNS, QueueItem
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    items TEXT NOT NULL,
+    error TEXT,
+    kind TEXT,
+    attempts INTEGER,
+    failed_at REAL NOT NULL
+)
+"""
+
+
+class DeadLetter:
+    __slots__ = ("id", "chat_id", "items", "error", "kind", "attempts",
+                 "failed_at")
+
+    def __init__(self, id: int, chat_id: int, items: List[QueueItem],
+                 error: str, kind: str, attempts: int, failed_at: float):
+        self.id = id
+        self.chat_id = chat_id
+        self.items = items
+        self.error = error
+        self.kind = kind
+        self.attempts = attempts
+        self.failed_at = failed_at
+
+
+class DeadLetterStore:
+    """Отправки, которые не удалось доставить в целевой чат.
+
+    Каждая запись - сообщения одной отправки и чат, куда они не дошли.
+    Записи можно просмотреть и отправить повторно (python main.py
+    dead-letters). Файл может открываться из нескольких процессов.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+        self._lock = asyncio.Lock()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def add(self, chat_id: int, items: List[QueueItem], error: str,
+                  kind: str, attempts: int) -> Optional[int]:
+        if self._db is None:
+            logger.error(f"Недоставленное в {chat_id} не сохранено: "
+                         f"хранилище не открыто")
+            return None
+        payload = json.dumps(
+            [{column: getattr(item, column) for column in COLUMNS}
+             for item in items], ensure_ascii=False)
+        async with self._lock:
+            return await asyncio.to_thread(
+                self._insert, chat_id, payload, error, kind, attempts)
+
+    def _insert(self, chat_id: int, payload: str, error: str, kind: str,
+                attempts: int) -> int:
+        cursor = self._db.execute(
+            "INSERT INTO dead_letters "
+            "(chat_id, items, error, kind, attempts, failed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, payload, error, kind, attempts, time.time()))
+        return cursor.lastrowid
+
+    def list(self, ids: Optional[List[int]] = None) -> List[DeadLetter]:
+        query = ("SELECT id, chat_id, items, error, kind, attempts, "
+                 "failed_at FROM dead_letters")
+        params: List[int] = []
+        if ids:
+            query += f" WHERE id IN ({', '.join('?' for _ in ids)})"
+            params = ids
+        rows = self._db.execute(query + " ORDER BY id", params).fetchall()
+        return [DeadLetter(row_id, chat_id,
+                           [QueueItem(**fields) for fields in json.loads(
+                               items)],
+                           error, kind, attempts, failed_at)
+                for row_id, chat_id, items, error, kind, attempts, failed_at
+                in rows]
+
+    def remove(self, ids: List[int]):
+        self._db.executemany(
+            "DELETE FROM dead_letters WHERE id = ?", [(i,) for i in ids])
+
+    def last_id(self) -> int:
+        row = self._db.execute("SELECT MAX(id) FROM dead_letters").fetchone()
+        return row[0] or 0
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (время пересылки, id сообщения в целевом чате)
+Entry = Tuple[float, Optional[int]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posted_files (
+    chat_id INTEGER NOT NULL,
+    file_unique_id TEXT NOT NULL,
+    message_id INTEGER,
+    posted_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, file_unique_id)
+)
+"""
+
+
+class DedupCache:
+    """Недавно пересланные файлы по file_unique_id для каждого целевого чата.
+
+    LRU с ограниченным размером и временем жизни записи. Если задан путь,
+    записи дублируются в SQLite и переживают перезапуск. Файлы, которые
+    уже приняты, но ещё не отправлены, отмечаются отдельно (только
+    в памяти), чтобы повтор не проскочил, пока первый ждёт очереди.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000,
+                 path: Optional[str] = None, flush_interval: float = 1.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.flush_interval = flush_interval
+        self._entries: "OrderedDict[Tuple[int, str], Entry]" = OrderedDict()
+        self._writes: List[Tuple[int, str, Optional[int], float]] = []
+        self._pending: Dict[str, int] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def open(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+        cutoff = time.time() - self.ttl
+        self._db.execute(
+            "DELETE FROM posted_files WHERE posted_at < ?", (cutoff,))
+        rows = self._db.execute(
+            "SELECT chat_id, file_unique_id, message_id, posted_at "
+            "FROM posted_files ORDER BY posted_at DESC LIMIT ?",
+            (self.max_entries,)).fetchall()
+        for chat_id, file_unique_id, message_id, posted_at in reversed(rows):
+            self._entries[(chat_id, file_unique_id)] = (posted_at, message_id)
+        logger.info(f"Загружено записей о пересланных файлах: {len(rows)}")
+
+    def start(self):
+        if self._db is not None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._db is not None:
+            await self._flush()
+            self._db.close()
+            self._db = None
+
+    def get(self, chat_id: int, file_unique_id: str) -> Optional[int]:
+        # Возвращает id сообщения в целевом чате или 0, если id неизвестен
+        key = (chat_id, file_unique_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        posted_at, message_id = entry
+        if time.time() - posted_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return message_id or 0
+
+    def lookup(self, chat_ids: List[int],
+               file_unique_id: str) -> Dict[int, int]:
+        # Целевые чаты, где файл уже есть, и id сообщений в них
+        found = {}
+        for chat_id in chat_ids:
+            message_id = self.get(chat_id, file_unique_id)
+            if message_id is not None:
+                found[chat_id] = message_id
+        return found
+
+    def is_pending(self, file_unique_id: str) -> bool:
+        return file_unique_id in self._pending
+
+    def mark_pending(self, file_unique_id: str):
+        self._pending[file_unique_id] = self._pending.get(
+            file_unique_id, 0) + 1
+
+    def clear_pending(self, file_unique_id: str):
+        # Вызывается и после неудачной отправки: повтор снова разрешён
+        count = self._pending.get(file_unique_id, 0) - 1
+        if count > 0:
+            self._pending[file_unique_id] = count
+        else:
+            self._pending.pop(file_unique_id, None)
+
+    def add(self, chat_id: int, file_unique_id: str,
+            message_id: Optional[int]):
+        now = time.time()
+        key = (chat_id, file_unique_id)
+        self._entries[key] = (now, message_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if self._db is not None:
+            self._writes.append((chat_id, file_unique_id, message_id, now))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, []
+        try:
+            await asyncio.to_thread(self._write, writes)
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша дубликатов: {e}")
+
+    def _write(self, writes: List[Tuple[int, str, Optional[int], float]]):
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO posted_files "
+                "(chat_id, file_unique_id, message_id, posted_at) "
+                "VALUES (?, ?, ?, ?)", writes)
+            self._db.execute(
+                "DELETE FROM posted_files WHERE posted_at < ?",
+                (time.time() - self.ttl,))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+
+def message_link(chat_id: int, message_id: int) -> Optional[str]:
+    # Ссылки вида t.me/c/... есть только у супергрупп и каналов
+    text = str(chat_id)
+    if not message_id or not text.startswith("-100"):
+        return None
+    return f"https://t.me/c/{text[4:]}/{message_id}"
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as Tally
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from aiogram import BaseMiddleware
+
+from metrics import LOOP_LAG, LOOP_STALLS, SLOW_CALLS
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """Задержка цикла событий и зависания с трассировкой.
+
+    Фоновая задача раз в interval замеряет, насколько позже срока она
+    проснулась. Отдельный поток следит, чтобы цикл не стоял дольше
+    threshold, и при зависании пишет в лог стек потока цикла - то место,
+    где синхронный код не отдаёт управление.
+    """
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.2):
+        self.interval = interval
+        self.threshold = threshold
+        self._thread_id: Optional[int] = None
+        self._tick = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._tick = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog:
+            self._stopped.set()
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - started - self.interval))
+            self._tick = time.monotonic()
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            tick = self._tick
+            stalled = time.monotonic() - tick - self.interval
+            # О каждом зависании сообщаем один раз
+            if stalled < self.threshold or reported == tick:
+                continue
+            reported = tick
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logger.warning(f"Цикл событий заблокирован дольше "
+                           f"{stalled * 1000:.0f} мс:\n{stack}")
+
+
+def coroutine_stack(coro: Any) -> List[str]:
+    # Цепочка await от корня задачи до места, где она сейчас ждёт
+    lines = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(
+            coro, "gi_frame", None)
+        if frame is None:
+            break
+        lines.append(f'  File "{frame.f_code.co_filename}", line '
+                     f'{frame.f_lineno}, in {frame.f_code.co_name}')
+        coro = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None)
+    return lines
+
+
+def _report_slow(name: str, label: str, threshold: float,
+                 task: asyncio.Task):
+    SLOW_CALLS.inc(name=name)
+    stack = "\n".join(coroutine_stack(task.get_coro()))
+    logger.warning(f"{name}{label} выполняется дольше {threshold:.1f} сек., "
+                   f"сейчас ожидает в:\n{stack}")
+
+
+@contextmanager
+def watch_slow(name: str, threshold: float, label: str = "") -> Iterator:
+    """Если блок выполняется дольше threshold, стек задачи пишется в лог.
+
+    Снимок делается, пока блок ещё ждёт, поэтому видно, на каком await
+    он застрял: лимите отправки, паузе RetryAfter или запросе к API.
+    label попадает только в лог, в метрике остаётся name.
+    """
+    task = asyncio.current_task()
+    if not threshold or task is None:
+        yield
+        return
+    timer = asyncio.get_running_loop().call_later(
+        threshold, _report_slow, name, label, threshold, task)
+    try:
+        yield
+    finally:
+        timer.cancel()
+
+
+class SlowHandlerMiddleware(BaseMiddleware):
+    """Пишет в лог стек обработчика, который работает дольше threshold."""
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None),
+                       "__name__", "unknown")
+        with watch_slow(f"Обработчик {name}", self.threshold):
+            return await handler(event, data)
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик потока цикла событий.
+
+    Раз в interval снимает стек потока и считает одинаковые стеки.
+    Включается и выключается без перезапуска процесса; результат
+    пишется в формате folded (flamegraph.pl, speedscope).
+    """
+
+    def __init__(self, interval: float = 0.01, directory: str = "logs"):
+        self.interval = interval
+        self.directory = directory
+        self._stacks: Tally = Tally()
+        self._samples = 0
+        self._thread_id: Optional[int] = None
+        self._started_at = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.running:
+            return
+        self._stacks.clear()
+        self._samples = 0
+        self._thread_id = threading.get_ident()
+        self._started_at = time.time()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Профилирование запущено, выборка раз в "
+                    f"{self.interval * 1000:.0f} мс")
+
+    def stop(self) -> Optional[str]:
+        if not self.running:
+            return None
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, time.strftime(
+            "profile-%Y%m%d-%H%M%S.folded",
+            time.localtime(self._started_at)))
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Профиль записан в {path}: {self._samples} выборок "
+                    f"за {time.time() - self._started_at:.1f} сек.")
+        # Функции, которые чаще всего оказывались на вершине стека
+        leaves: Tally = Tally()
+        for stack, count in self._stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        for leaf, count in leaves.most_common(10):
+            logger.info(f"  {count * 100 / max(1, self._samples):5.1f}% "
+                        f"{leaf}")
+        return path
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{code.co_firstlineno})")
+                frame = frame.f_back
+            self._stacks[";".join(reversed(names))] += 1
+            self._samples += 1
@@ -0,0 +1,109 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Hashable, List, Optional, Set
+
+
+class Flow:
+    __slots__ = ("jobs", "deficit")
+
+    def __init__(self):
+        self.jobs: Deque[Any] = deque()
+        self.deficit = 0
+
+
+class FairQueue:
+    """Очередь доставки с полосами приоритета и честной очерёдностью.
+
+    Задание попадает в полосу lane(job), меньший номер важнее: пока в
+    важной полосе есть что отправлять, следующие ждут. Внутри полосы у
+    каждого отправителя своя очередь, отправители обслуживаются по кругу
+    с дефицитом (DRR): за круг отправитель получает quantum единиц
+    cost(job), и альбом из десяти файлов стоит десяти одиночных, а
+    длинный хвост одного отправителя не задерживает остальных. У
+    отправителя в работе не больше одного задания, и его сообщения
+    внутри полосы уходят по порядку.
+    """
+
+    def __init__(self, lane: Callable[[Any], int],
+                 sender: Callable[[Any], Hashable],
+                 cost: Callable[[Any], int] = lambda job: 1,
+                 lanes: int = 3, quantum: int = 1):
+        self.lane = lane
+        self.sender = sender
+        self.cost = cost
+        self.quantum = quantum
+        self._lanes: List["OrderedDict[Hashable, Flow]"] = [
+            OrderedDict() for _ in range(lanes)]
+        self._busy: Set[Hashable] = set()
+        self._size = 0
+        self._unfinished = 0
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def lane_sizes(self) -> List[int]:
+        return [sum(len(flow.jobs) for flow in flows.values())
+                for flows in self._lanes]
+
+    def put_nowait(self, job: Any):
+        flows = self._lanes[self.lane(job)]
+        sender = self.sender(job)
+        flow = flows.get(sender)
+        if flow is None:
+            flow = flows[sender] = Flow()
+        flow.jobs.append(job)
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._changed.set()
+
+    async def get(self) -> Any:
+        while True:
+            job = self._pop()
+            if job is not None:
+                return job
+            self._changed.clear()
+            await self._changed.wait()
+
+    def task_done(self, job: Any):
+        self._busy.discard(self.sender(job))
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._finished.set()
+        # Освободившийся отправитель может быть следующим в очереди
+        self._changed.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def _pop(self) -> Optional[Any]:
+        for flows in self._lanes:
+            free = [(sender, flow) for sender, flow in flows.items()
+                    if sender not in self._busy]
+            if not free:
+                continue
+            # Сразу начисляем столько кругов, сколько нужно первому
+            # отправителю, который сможет оплатить своё задание
+            need = min(self.cost(flow.jobs[0]) - flow.deficit
+                       for _, flow in free)
+            if need > 0:
+                rounds = -(-need // self.quantum)
+                for _, flow in free:
+                    flow.deficit += rounds * self.quantum
+            for sender, flow in free:
+                cost = self.cost(flow.jobs[0])
+                if flow.deficit < cost:
+                    continue
+                flow.deficit -= cost
+                job = flow.jobs.popleft()
+                if flow.jobs:
+                    flows.move_to_end(sender)
+                else:
+                    del flows[sender]
+                self._busy.add(sender)
+                self._size -= 1
+                return job
+        return None
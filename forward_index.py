@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS forwarded (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    target_chat_id INTEGER NOT NULL,
+    target_message_id INTEGER NOT NULL,
+    posted_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id, target_chat_id)
+)
+"""
+
+Source = Tuple[int, int]
+
+
+class ForwardIndex:
+    """Где в целевых чатах лежит копия исходного сообщения.
+
+    Ключ - (chat_id, message_id) исходного сообщения, значение - id копий
+    по целевым чатам. LRU с ограниченным числом исходных сообщений; если
+    задан путь, записи дублируются в SQLite и переживают перезапуск.
+    """
+
+    def __init__(self, max_entries: int = 10000, path: Optional[str] = None,
+                 flush_interval: float = 1.0):
+        self.max_entries = max_entries
+        self.path = path
+        self.flush_interval = flush_interval
+        self._entries: "OrderedDict[Source, Dict[int, int]]" = OrderedDict()
+        self._writes: List[Tuple[int, int, int, int, float]] = []
+        self._db: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def open(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+        # Таблица ограничена при записи, лишнее вытеснит LRU
+        rows = self._db.execute(
+            "SELECT chat_id, message_id, target_chat_id, target_message_id "
+            "FROM forwarded ORDER BY posted_at").fetchall()
+        for chat_id, message_id, target_chat_id, target_message_id in rows:
+            self._store((chat_id, message_id), target_chat_id,
+                        target_message_id)
+        logger.info(f"Загружено записей о пересланных сообщениях: "
+                    f"{len(rows)}")
+
+    def start(self):
+        if self._db is not None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._db is not None:
+            await self._flush()
+            self._db.close()
+            self._db = None
+
+    def get(self, chat_id: int, message_id: int) -> Dict[int, int]:
+        key = (chat_id, message_id)
+        targets = self._entries.get(key)
+        if targets is None:
+            return {}
+        self._entries.move_to_end(key)
+        return dict(targets)
+
+    def add(self, chat_id: int, message_id: int, target_chat_id: int,
+            target_message_id: int):
+        self._store((chat_id, message_id), target_chat_id, target_message_id)
+        if self._db is not None:
+            self._writes.append((chat_id, message_id, target_chat_id,
+                                 target_message_id, time.time()))
+
+    def _store(self, key: Source, target_chat_id: int,
+               target_message_id: int):
+        self._entries.setdefault(key, {})[target_chat_id] = target_message_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, []
+        try:
+            await asyncio.to_thread(self._write, writes)
+        except Exception as e:
+            logger.error(f"Ошибка записи индекса пересланных сообщений: {e}")
+
+    def _write(self, writes: List[Tuple[int, int, int, int, float]]):
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO forwarded "
+                "(chat_id, message_id, target_chat_id, target_message_id, "
+                "posted_at) VALUES (?, ?, ?, ?, ?)", writes)
+            # Храним не больше записей, чем помещается в память
+            self._db.execute(
+                "DELETE FROM forwarded WHERE (chat_id, message_id) NOT IN ("
+                "SELECT chat_id, message_id FROM forwarded "
+                "GROUP BY chat_id, message_id "
+                "ORDER BY MAX(posted_at) DESC LIMIT ?)",
+                (self.max_entries,))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import Dict
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware, NextRequestMiddlewareType)
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.types import InputMediaVideo
+
+logger = logging.getLogger(__name__)
+
+MEDIA_METHODS = {"sendPhoto", "sendDocument", "sendAudio", "sendVoice",
+                 "sendMediaGroup"}
+VIDEO_METHODS = {"sendVideo", "sendVideoNote", "sendAnimation"}
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """Сессия Bot API с настраиваемым пулом соединений.
+
+    Таймаут запроса зависит от метода: короткий для текстов и служебных
+    вызовов, длиннее для файлов и самый длинный для видео. Соединения
+    можно открыть заранее, чтобы первые отправки после запуска не ждали
+    установки TLS.
+    """
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 60.0,
+                 dns_ttl: int = 3600, timeout: float = 10.0,
+                 media_timeout: float = 120.0, video_timeout: float = 300.0,
+                 **kwargs):
+        super().__init__(limit=limit, timeout=timeout, **kwargs)
+        self._connector_init.update(
+            keepalive_timeout=keepalive_timeout, ttl_dns_cache=dns_ttl)
+        self.media_timeout = media_timeout
+        self.video_timeout = video_timeout
+
+    def timeout_for(self, method: TelegramMethod) -> float:
+        # getUpdates сюда не попадает: aiogram сам передаёт таймаут
+        # long polling вместе с запросом
+        name = method.__api_method__
+        if name in VIDEO_METHODS:
+            return self.video_timeout
+        if name == "sendMediaGroup" and any(
+                isinstance(media, InputMediaVideo) for media in method.media):
+            return self.video_timeout
+        if name in MEDIA_METHODS:
+            return self.media_timeout
+        return self.timeout
+
+    async def make_request(self, bot: Bot, method: TelegramMethod,
+                           timeout=None):
+        if timeout is None:
+            timeout = self.timeout_for(method)
+        return await super().make_request(bot, method, timeout)
+
+    async def warm_up(self, bot: Bot, connections: int) -> int:
+        # Параллельные getMe открывают столько же соединений, которые
+        # остаются в пуле до истечения keep-alive
+        results = await asyncio.gather(
+            *(bot.get_me() for _ in range(connections)),
+            return_exceptions=True)
+        errors = [result for result in results
+                  if isinstance(result, Exception)]
+        if errors:
+            logger.warning(f"Не удалось прогреть соединения: {errors[0]}")
+        return connections - len(errors)
+
+    def pool_stats(self) -> Dict[str, int]:
+        connector = None
+        if self._session is not None and not self._session.closed:
+            connector = self._session.connector
+        if connector is None:
+            return {"limit": self._connector_init.get("limit", 0),
+                    "active": 0, "idle": 0}
+        return {
+            "limit": connector.limit,
+            "active": len(getattr(connector, "_acquired", ())),
+            "idle": sum(len(conns) for conns in
+                        getattr(connector, "_conns", {}).values()),
+        }
+
+
+class UpdatesLimitMiddleware(BaseRequestMiddleware):
+    """Ограничивает число обновлений, которые getUpdates отдаёт за раз."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+
+    async def __call__(self, make_request: NextRequestMiddlewareType,
+                       bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates) and self.limit:
+            method.limit = self.limit
+        return await make_request(bot, method)
@@ -0,0 +1,84 @@
+import json
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import List
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# Поля, которые передаются через extra= и попадают в JSON как есть
+CONTEXT_FIELDS = ("sender_id", "chat_id", "media_group_id", "latency_ms",
+                  "outcome")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись с контекстом доставки."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ListenerHandler(QueueHandler):
+    """QueueHandler, который владеет потоком записи логов.
+
+    Обработчики вызывают только put в очередь; файл и консоль пишет
+    отдельный поток. Закрытие (в том числе в logging.shutdown при выходе)
+    дописывает очередь и останавливает поток.
+    """
+
+    def __init__(self, handlers: List[logging.Handler]):
+        log_queue = queue.SimpleQueue()
+        super().__init__(log_queue)
+        self.listener = QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Для JSON сообщение и исключение форматирует конечный обработчик
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record.exc_info = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super().close()
+
+
+def setup_logging(handlers: List[logging.Handler], fmt: str = "text",
+                  level: int = logging.INFO) -> ListenerHandler:
+    if fmt not in ("text", "json"):
+        raise ValueError(f"Неизвестный LOG_FORMAT: {fmt}")
+    formatter = JsonFormatter() if fmt == "json" \
+        else logging.Formatter(TEXT_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    handler = ListenerHandler(handlers)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    return handler
@@ -1,24 +1,57 @@
 import os
+import signal
+import sys
+import time
 import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
-from typing import Optional
-from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
-    Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument, BotCommand
+    Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument, BotCommand,
+    ReplyParameters, ReactionTypeEmoji
 )
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.exceptions import (
-    TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter)
-from dotenv import load_dotenv
+from aiogram.webhook.aiohttp_server import (
+    SimpleRequestHandler, setup_application)
+from aiohttp import web
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from dotenv import dotenv_values, load_dotenv
+
+from albums import (
+    AlbumFlushPolicy, BatchScheduler, FixedFlushPolicy, plan_groups)
+from dead_letters import DeadLetterStore
+from dedup import DedupCache, message_link
+from diagnostics import (
+    LoopMonitor, SamplingProfiler, SlowHandlerMiddleware, watch_slow)
+from fair_queue import FairQueue
+from forward_index import ForwardIndex
+from http_session import TunedAiohttpSession, UpdatesLimitMiddleware
+from log_config import setup_logging
+from metrics import (
+    DEAD_LETTERS, DEDUP_HITS, DEDUP_SAVED_CALLS, REGISTRY, SEND_LATENCY,
+    HandlerMetricsMiddleware,
+    RequestMetricsMiddleware, start_metrics_server)
+from outbox import SKIP_ALL, Outbox, QueueItem
+from retry import EXHAUSTED, PERMANENT, RetryError, RetryPolicy, retry
+from rate_limiter import (
+    InflightLimiter, RateLimitMiddleware, SendScheduler,
+    SenderLimitMiddleware, SenderOrderMiddleware)
+from workers import WorkerDied, WorkerPool, serve_jobs
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
-# Логирование
+# Переменные окружения процесса важнее .env, в том числе при SIGHUP
+ENVIRON_KEYS = frozenset(os.environ)
+load_dotenv()
+DOTENV_KEYS = set(os.environ) - ENVIRON_KEYS
+
+# Логирование: запись в файл и консоль идёт в отдельном потоке,
+# обработчики только кладут записи в очередь
 log_file = os.path.join(LOG_DIR, "bot.log")
 file_handler = RotatingFileHandler(
     log_file,
@@ -27,27 +60,160 @@ file_handler = RotatingFileHandler(
     encoding="utf-8"
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        file_handler,
-        logging.StreamHandler()
-    ]
-)
+# Формат логов: text или json (одна JSON-строка на запись)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+setup_logging([file_handler, logging.StreamHandler()], LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 # Настройки
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
-MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE_MB", "50")) * 1024 * 1024
+# Свой сервер telegram-bot-api (пусто - облачный Bot API)
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+# Сервер запущен с --local и видит те же файлы, что и бот
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "").lower() in ("1", "true", "yes")
+
+
+def max_file_size() -> int:
+    # Сервер с --local принимает файлы до 2000 МБ, облачный Bot API и
+    # свой сервер без --local - до 50 МБ
+    default = "2000" if BOT_API_LOCAL else "50"
+    return int(os.getenv("MAX_FILE_SIZE_MB", default)) * 1024 * 1024
+
+
+MAX_FILE_SIZE = max_file_size()
+
+# Сколько целевых чатов обслуживается одновременно
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "5"))
+# Сколько отправок от разных отправителей выполняется одновременно
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+# Сколько при остановке ждать доставки уже принятых сообщений
+DRAIN_TIMEOUT_SEC = float(os.getenv("DRAIN_TIMEOUT_SEC", "25"))
+
+# Диагностика: задержка цикла событий, медленные обработчики и отправки
+LOOP_LAG_INTERVAL_MS = int(os.getenv("LOOP_LAG_INTERVAL_MS", "500"))
+LOOP_STALL_MS = int(os.getenv("LOOP_STALL_MS", "200"))
+SLOW_HANDLER_MS = int(os.getenv("SLOW_HANDLER_MS", "1000"))
+SLOW_SEND_MS = int(os.getenv("SLOW_SEND_MS", "30000"))
+# Интервал выборки профилировщика, который включается сигналом SIGUSR1
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "10"))
+# Отдельные процессы доставки (0 - доставка в процессе приёма)
+DELIVERY_PROCESSES = int(os.getenv("DELIVERY_PROCESSES", "0"))
+
+# Повторы отправки: экспоненциальная пауза с джиттером в пределах бюджета
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SEC = float(os.getenv("RETRY_BASE_DELAY_SEC", "1"))
+RETRY_MAX_DELAY_SEC = float(os.getenv("RETRY_MAX_DELAY_SEC", "30"))
+RETRY_BUDGET_SEC = float(os.getenv("RETRY_BUDGET_SEC", "120"))
+# Недоставленные после всех повторов отправки
+DEAD_LETTER_PATH = os.getenv(
+    "DEAD_LETTER_PATH", os.path.join(BASE_DIR, "data", "dead_letters.sqlite3"))
+
+# Лимит сообщений от одного отправителя (0 - выключено): сверх лимита
+# сообщения ждут, а дольше SENDER_MAX_DELAY_SEC - отклоняются
+SENDER_RATE_PER_MIN = float(os.getenv("SENDER_RATE_PER_MIN", "0"))
+SENDER_BURST = int(os.getenv("SENDER_BURST", "30"))
+SENDER_MAX_DELAY_SEC = float(os.getenv("SENDER_MAX_DELAY_SEC", "30"))
+# Сколько необработанных сообщений одного отправителя может ждать своей
+# очереди (0 - без ограничения); следующие ждут, пока не освободится место
+SENDER_MAX_QUEUED = int(os.getenv("SENDER_MAX_QUEUED", "0"))
+# Сколько принятых сообщений может ждать доставки (0 - без ограничения)
+INFLIGHT_LIMIT = int(os.getenv("INFLIGHT_LIMIT", "1000"))
+
+# Пул HTTP-соединений к Bot API и таймауты по типу запроса
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "60"))
+HTTP_DNS_TTL_SEC = int(os.getenv("HTTP_DNS_TTL_SEC", "3600"))
+HTTP_TIMEOUT_SEC = float(os.getenv("HTTP_TIMEOUT_SEC", "10"))
+HTTP_MEDIA_TIMEOUT_SEC = float(os.getenv("HTTP_MEDIA_TIMEOUT_SEC", "120"))
+HTTP_VIDEO_TIMEOUT_SEC = float(os.getenv("HTTP_VIDEO_TIMEOUT_SEC", "300"))
+# Сколько соединений открыть при запуске
+HTTP_WARM_CONNECTIONS = int(os.getenv("HTTP_WARM_CONNECTIONS", "4"))
+
+# Лимиты Telegram на исходящие сообщения
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "30"))
+RATE_GROUP_PER_MIN = float(os.getenv("RATE_GROUP_PER_MIN", "20"))
+RATE_PRIVATE_PER_SEC = float(os.getenv("RATE_PRIVATE_PER_SEC", "1"))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Long polling: ожидание на сервере Telegram и размер пачки обновлений
+POLLING_TIMEOUT_SEC = int(os.getenv("POLLING_TIMEOUT_SEC", "30"))
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", "100"))
+# Сколько обновлений обрабатывается одновременно (0 - без ограничения);
+# обновления одного отправителя всегда обрабатываются по порядку
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "64"))
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Очередь принятых сообщений на диске
+OUTBOX_PATH = os.getenv(
+    "OUTBOX_PATH", os.path.join(BASE_DIR, "data", "outbox.sqlite3"))
+OUTBOX_COMMIT_INTERVAL_MS = int(os.getenv("OUTBOX_COMMIT_INTERVAL_MS", "10"))
+
+# Ожидание частей альбома: окно тишины подстраивается в этих пределах
+ALBUM_MIN_QUIET_MS = int(os.getenv("ALBUM_MIN_QUIET_MS", "250"))
+ALBUM_MAX_QUIET_MS = int(os.getenv("ALBUM_MAX_QUIET_MS", "5000"))
+ALBUM_MAX_WAIT_MS = int(os.getenv("ALBUM_MAX_WAIT_MS", "10000"))
+# Лимиты на число файлов в буфере альбомов
+ALBUM_MAX_BUFFERED_PER_CHAT = int(
+    os.getenv("ALBUM_MAX_BUFFERED_PER_CHAT", "100"))
+ALBUM_MAX_BUFFERED = int(os.getenv("ALBUM_MAX_BUFFERED", "10000"))
+
+# Склейка подряд идущих текстов одного отправителя (0 - выключено)
+TEXT_COALESCE_MS = int(os.getenv("TEXT_COALESCE_MS", "0"))
+TEXT_COALESCE_MAX_WAIT_MS = int(
+    os.getenv("TEXT_COALESCE_MAX_WAIT_MS", str(TEXT_COALESCE_MS * 4)))
+
+# Подтверждение доставки отправителю: reply - ответ на каждое сообщение,
+# reaction - реакция на сообщение, batch - один ответ на серию сообщений,
+# errors - только сообщения об ошибках
+ACK_MODE = os.getenv("ACK_MODE", "reply").lower()
+ACK_REACTION = os.getenv("ACK_REACTION", "👍")
+ACK_BATCH_MS = int(os.getenv("ACK_BATCH_MS", "3000"))
+ACK_BATCH_MAX_WAIT_MS = int(
+    os.getenv("ACK_BATCH_MAX_WAIT_MS", str(ACK_BATCH_MS * 5)))
+
+# Подавление повторной пересылки одного и того же файла (0 - выключено)
+DEDUP_TTL_SEC = int(os.getenv("DEDUP_TTL_SEC", "0"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+DEDUP_PATH = os.getenv("DEDUP_PATH", "")
+
+# Где лежат копии сообщений, чтобы править их при редактировании исходных
+FORWARD_INDEX_MAX_ENTRIES = int(
+    os.getenv("FORWARD_INDEX_MAX_ENTRIES", "10000"))
+FORWARD_INDEX_PATH = os.getenv("FORWARD_INDEX_PATH", "")
+
+# HTTP-эндпоинт метрик и проверок здоровья (выключен, если порт не задан)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в .env")
 if not CHAT_ID:
     raise ValueError("CHAT_ID не найден в .env")
-CHAT_ID = int(CHAT_ID)
+
+
+def parse_chat_ids(value: str) -> List[int]:
+    # Несколько целевых чатов перечисляются через запятую
+    return [int(chat_id) for chat_id in value.split(",") if chat_id.strip()]
+
+
+CHAT_IDS = parse_chat_ids(CHAT_ID)
+# Каждый чат обслуживает один процесс: лишний простаивал бы, забирая
+# свою долю общего лимита отправки
+DELIVERY_PROCESSES = min(DELIVERY_PROCESSES, len(CHAT_IDS))
+if ACK_MODE not in ("reply", "reaction", "batch", "errors"):
+    raise ValueError(f"Неизвестный ACK_MODE: {ACK_MODE}")
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE}")
+# Без секрета любой, кто узнал адрес, может прислать поддельное обновление,
+# и бот перешлёт его в чат
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET обязателен в режиме webhook")
 
 dp = Dispatcher()
 
@@ -56,16 +222,614 @@ ALLOWED_PHOTO_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif"}
 ALLOWED_VIDEO_EXTS = {".mp4", ".mov", ".avi", ".mkv", ".wmv", ".webm", ".mpeg"}
 
 MEDIA_GROUP_LIMIT = 10
+TEXT_MESSAGE_LIMIT = 4096
 
-media_buffer = {}
-album_timers = {}
+# Полосы доставки: тексты важнее одиночных файлов, те важнее альбомов
+LANE_TEXT, LANE_FILE, LANE_ALBUM = range(3)
+LANE_NAMES = ("texts", "files", "albums")
+
+# Копии в одном целевом чате:
+# (chat_id, message_id, file_unique_id) исходного -> id копии
+Posted = Dict[Tuple[int, int, Optional[str]], int]
+
+album_scheduler = BatchScheduler(
+    AlbumFlushPolicy(
+        min_quiet=ALBUM_MIN_QUIET_MS / 1000,
+        max_quiet=ALBUM_MAX_QUIET_MS / 1000,
+        max_wait=ALBUM_MAX_WAIT_MS / 1000,
+    ),
+    on_flush=lambda items: delivery_queue.put_nowait(items),
+    group_limit=MEDIA_GROUP_LIMIT,
+    max_per_chat=ALBUM_MAX_BUFFERED_PER_CHAT,
+    max_total=ALBUM_MAX_BUFFERED,
+)
+
+text_scheduler = BatchScheduler(
+    FixedFlushPolicy(
+        quiet=TEXT_COALESCE_MS / 1000,
+        max_wait=TEXT_COALESCE_MAX_WAIT_MS / 1000,
+    ),
+    on_flush=lambda items: delivery_queue.put_nowait(items),
+    group_limit=100,
+    label="пачка текстов",
+) if TEXT_COALESCE_MS else None
+
+# Подтверждения копятся по отправителю, пока он присылает сообщения
+ack_scheduler = BatchScheduler(
+    FixedFlushPolicy(
+        quiet=ACK_BATCH_MS / 1000,
+        max_wait=ACK_BATCH_MAX_WAIT_MS / 1000,
+    ),
+    on_flush=lambda jobs: send_summary(jobs),
+    group_limit=100,
+    label="пачка подтверждений",
+) if ACK_MODE == "batch" else None
+
+dedup = DedupCache(
+    DEDUP_TTL_SEC, max_entries=DEDUP_MAX_ENTRIES, path=DEDUP_PATH or None
+) if DEDUP_TTL_SEC else None
+
+forward_index = ForwardIndex(
+    FORWARD_INDEX_MAX_ENTRIES, path=FORWARD_INDEX_PATH or None)
+
+outbox = Outbox(OUTBOX_PATH, commit_interval=OUTBOX_COMMIT_INTERVAL_MS / 1000)
+dead_letters = DeadLetterStore(DEAD_LETTER_PATH)
+send_retry = RetryPolicy(
+    attempts=RETRY_ATTEMPTS,
+    base_delay=RETRY_BASE_DELAY_SEC,
+    max_delay=RETRY_MAX_DELAY_SEC,
+    budget=RETRY_BUDGET_SEC,
+)
+# Ответ пользователю не должен надолго задерживать очередь доставки
+notify_retry = RetryPolicy(attempts=3, base_delay=RETRY_BASE_DELAY_SEC,
+                           max_delay=RETRY_MAX_DELAY_SEC, budget=10)
+delivery_queue: Optional[FairQueue] = None
+delivery_tasks: List[asyncio.Task] = []
+# Принятые сообщения по (чат, id): ещё ждущие в буфере или очереди
+# и уже отправляемые - правки к ним применяются до или после отправки
+queued_items: Dict[Tuple[int, int], QueueItem] = {}
+sending_items: Dict[Tuple[int, int], asyncio.Event] = {}
+fanout_semaphore: Optional[asyncio.Semaphore] = None
+worker_pool: Optional[WorkerPool] = None
+ack_tasks = set()
+ack_bot: Optional[Bot] = None
+api_session: Optional[TunedAiohttpSession] = None
+inflight = InflightLimiter(INFLIGHT_LIMIT)
+loop_monitor = LoopMonitor(
+    LOOP_LAG_INTERVAL_MS / 1000, LOOP_STALL_MS / 1000
+) if LOOP_LAG_INTERVAL_MS else None
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000, LOG_DIR)
+
+# Лимит на отправителя решает до его очереди, задержка выдерживается
+# уже в очереди и снаружи замера времени обработчиков
+sender_limit = SenderLimitMiddleware(
+    rate=SENDER_RATE_PER_MIN / 60,
+    burst=SENDER_BURST,
+    max_delay=SENDER_MAX_DELAY_SEC,
+    inflight=inflight,
+    max_queued=SENDER_MAX_QUEUED,
+)
+# Порядок и параллельность обработки обновлений; остановка ждёт и те
+# обновления, что ещё ждут места в очереди отправителя
+sender_order = SenderOrderMiddleware(HANDLER_CONCURRENCY)
+dp.update.outer_middleware(sender_order.track)
+dp.update.outer_middleware(sender_limit)
+dp.update.outer_middleware(sender_order)
+dp.message.middleware(sender_limit.pace)
+dp.edited_message.middleware(sender_limit.pace)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.edited_message.middleware(HandlerMetricsMiddleware())
+if SLOW_HANDLER_MS:
+    dp.message.middleware(SlowHandlerMiddleware(SLOW_HANDLER_MS / 1000))
+    dp.edited_message.middleware(
+        SlowHandlerMiddleware(SLOW_HANDLER_MS / 1000))
+REGISTRY.gauge("bot_album_buffer_items", "Файлов в буфере альбомов",
+               lambda: album_scheduler.total)
+REGISTRY.gauge("bot_album_pending", "Альбомов, ожидающих отправки",
+               lambda: len(album_scheduler))
+REGISTRY.gauge("bot_delivery_queue_depth", "Отправок в очереди доставки",
+               lambda: delivery_queue.qsize() if delivery_queue else 0)
+for lane, lane_name in enumerate(LANE_NAMES):
+    REGISTRY.gauge(f"bot_delivery_queue_{lane_name}",
+                   f"Отправок в очереди доставки, полоса {lane_name}",
+                   lambda lane=lane: delivery_queue.lane_sizes()[lane]
+                   if delivery_queue else 0)
+REGISTRY.gauge("bot_updates_in_progress", "Обновлений в обработке",
+               lambda: sender_order.running)
+REGISTRY.gauge("bot_inflight_items", "Принятых сообщений, ожидающих доставки",
+               lambda: inflight.count)
+REGISTRY.gauge("bot_http_pool_limit", "Размер пула HTTP-соединений",
+               lambda: http_pool_stat("limit"))
+REGISTRY.gauge("bot_http_connections_active",
+               "HTTP-соединений с запросом в работе",
+               lambda: http_pool_stat("active"))
+REGISTRY.gauge("bot_http_connections_idle",
+               "Открытых HTTP-соединений в ожидании запроса",
+               lambda: http_pool_stat("idle"))
 
 
 @dp.startup()
 async def on_startup(bot: Bot):
+    global api_session
+    api_session = bot.session
+    if HTTP_WARM_CONNECTIONS:
+        warmed = await bot.session.warm_up(bot, HTTP_WARM_CONNECTIONS)
+        logger.info(f"Открыто соединений с Bot API: {warmed}")
     commands = [BotCommand(command="start", description="Начать работу")]
     await bot.set_my_commands(commands)
     logger.info("Меню команд бота установлено")
+    start_delivery(bot)
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await stop_delivery()
+
+
+def start_delivery(bot: Bot):
+    global delivery_queue, fanout_semaphore, worker_pool, ack_bot
+    ack_bot = bot
+    outbox.open()
+    outbox.start()
+    dead_letters.open()
+    if dedup is not None:
+        dedup.open()
+        dedup.start()
+    forward_index.open()
+    forward_index.start()
+    delivery_queue = FairQueue(
+        lane=job_lane, sender=lambda items: items[0].sender_id, cost=len)
+    fanout_semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    if DELIVERY_PROCESSES:
+        worker_pool = WorkerPool(DELIVERY_PROCESSES, delivery_process)
+        worker_pool.start()
+    # Повторная доставка того, что не успели отправить до перезапуска
+    jobs = pending_jobs(outbox.pending())
+    for items in jobs:
+        inflight.add(len(items))
+        for item in items:
+            accept_item(item)
+            if dedup is not None and item.file_unique_id:
+                dedup.mark_pending(item.file_unique_id)
+        delivery_queue.put_nowait(items)
+    if jobs:
+        logger.info(f"Восстановлено из очереди: {len(jobs)} отправок")
+    # С процессами доставки каждое задание уходит во все процессы, и
+    # DELIVERY_WORKERS заданий в работе - это столько же в каждом из них
+    delivery_tasks[:] = [asyncio.create_task(delivery_worker(bot))
+                         for _ in range(max(1, DELIVERY_WORKERS))]
+    album_scheduler.start()
+    if text_scheduler is not None:
+        text_scheduler.start()
+    if ack_scheduler is not None:
+        ack_scheduler.start()
+
+
+async def stop_delivery():
+    global worker_pool
+    await drain(DRAIN_TIMEOUT_SEC)
+    if ack_scheduler is not None:
+        # Накопленные подтверждения отправляются сразу
+        ack_scheduler.flush_all()
+        await ack_scheduler.stop()
+        if ack_tasks:
+            await asyncio.wait(list(ack_tasks), timeout=5)
+    # Что не успело уйти, уже на диске и будет доставлено после запуска
+    await album_scheduler.stop()
+    album_scheduler.clear()
+    if text_scheduler is not None:
+        await text_scheduler.stop()
+        text_scheduler.clear()
+    for task in delivery_tasks:
+        task.cancel()
+    if delivery_tasks:
+        await asyncio.gather(*delivery_tasks, return_exceptions=True)
+        delivery_tasks.clear()
+    if worker_pool is not None:
+        # Незавершённые задания остаются в очереди на диске
+        await worker_pool.stop()
+        worker_pool = None
+    await outbox.close()
+    dead_letters.close()
+    if dedup is not None:
+        await dedup.close()
+    await forward_index.close()
+
+
+async def drain(timeout: float):
+    # Приём обновлений к этому моменту остановлен, но уже полученные
+    # ещё могут быть в обработчиках: сначала ждём их, затем недособранные
+    # альбомы уходят сразу, а отправки в работе ждём в пределах timeout
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Задачи последних обновлений успевают встать в очередь
+    await asyncio.sleep(0)
+    if sender_order.pending:
+        logger.info(f"Остановка: ожидание {sender_order.pending} "
+                    f"обновлений в обработке")
+        try:
+            await asyncio.wait_for(sender_order.join(), timeout)
+        except asyncio.TimeoutError:
+            # После закрытия outbox их запись уже не завершится
+            logger.warning(f"Остановка: прервана обработка "
+                           f"{sender_order.pending} обновлений")
+            sender_order.cancel()
+            await asyncio.sleep(0)
+    album_scheduler.flush_all()
+    if text_scheduler is not None:
+        text_scheduler.flush_all()
+    if delivery_queue is None or not inflight.count:
+        return
+    logger.info(f"Остановка: ожидание доставки {inflight.count} сообщений "
+                f"(не дольше {max(0.0, deadline - loop.time()):.0f} сек.)")
+    try:
+        await asyncio.wait_for(delivery_queue.join(),
+                               max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        pass
+    if inflight.count:
+        logger.warning(f"Остановка: не доставлено {inflight.count} "
+                       f"сообщений, они будут отправлены после запуска")
+    else:
+        logger.info("Остановка: все принятые сообщения доставлены")
+
+
+def pending_jobs(items: List[QueueItem]) -> List[List[QueueItem]]:
+    jobs = []
+    albums = {}
+    for item in items:
+        if item.media_group_id is None:
+            jobs.append([item])
+            continue
+        key = (item.chat_id, item.media_group_id)
+        if key not in albums:
+            albums[key] = []
+            jobs.append(albums[key])
+        albums[key].append(item)
+    return jobs
+
+
+def job_lane(items: List[QueueItem]) -> int:
+    if items[0].text:
+        return LANE_TEXT
+    return LANE_FILE if len(items) == 1 else LANE_ALBUM
+
+
+async def delivery_worker(bot: Bot):
+    while True:
+        items = await delivery_queue.get()
+        sent = start_sending(items)
+        try:
+            # Задание остаётся в очереди, пока его не выполнят: так полосы
+            # и очерёдность отправителей действуют и для процессов доставки
+            if worker_pool is not None:
+                await deliver_remote(bot, items)
+            else:
+                await deliver(bot, items)
+        except Exception as e:
+            logger.error(f"Ошибка доставки: {e}")
+        release_pending(items)
+        finish_sending(items, sent)
+        outbox.ack([item.id for item in items])
+        inflight.done(len(items))
+        delivery_queue.task_done(items)
+
+
+def accept_item(item: QueueItem):
+    queued_items[(item.chat_id, item.message_id)] = item
+
+
+def start_sending(items: List[QueueItem]) -> asyncio.Event:
+    # Вызывается сразу после get(): правка не успеет изменить задание,
+    # которое уже начали отправлять
+    sent = asyncio.Event()
+    for item in items:
+        key = (item.chat_id, item.message_id)
+        queued_items.pop(key, None)
+        sending_items[key] = sent
+    return sent
+
+
+def finish_sending(items: List[QueueItem], sent: asyncio.Event):
+    for item in items:
+        key = (item.chat_id, item.message_id)
+        if sending_items.get(key) is sent:
+            del sending_items[key]
+    sent.set()
+
+
+def release_pending(items: List[QueueItem]):
+    # Отправленные файлы уже в кэше повторов, неотправленные можно
+    # прислать заново
+    if dedup is None:
+        return
+    for item in items:
+        if item.file_unique_id and item.skip_chats != SKIP_ALL:
+            dedup.clear_pending(item.file_unique_id)
+
+
+def is_ready() -> bool:
+    if worker_pool is not None and not worker_pool.alive():
+        return False
+    return bool(delivery_tasks) and not any(
+        task.done() for task in delivery_tasks)
+
+
+def http_pool_stat(name: str) -> int:
+    return api_session.pool_stats()[name] if api_session else 0
+
+
+async def deliver(bot: Bot, items: List[QueueItem]):
+    results, posted = await send_job(bot, items, CHAT_IDS)
+    remember_posted(posted)
+    log_delivery(items, results)
+    await report(bot, items, results)
+
+
+async def send_job(bot: Bot, items: List[QueueItem], chat_ids: List[int]):
+    # Возвращает ошибки по чатам и id новых сообщений по file_unique_id
+    posted = {chat_id: {} for chat_id in chat_ids}
+    if items[0].text:
+        batches = merge_texts(items)
+        with SEND_LATENCY.time(path="text"):
+            results = await fan_out(
+                lambda chat_id: send_texts(
+                    bot, chat_id, batches, posted[chat_id]), chat_ids)
+    else:
+        with SEND_LATENCY.time(path="album" if len(items) > 1 else "file"):
+            results = await fan_out(
+                lambda chat_id: send_files(
+                    bot, chat_id, items, posted[chat_id]), chat_ids)
+    return results, posted
+
+
+async def send_files(bot: Bot, chat_id: int, items: List[QueueItem],
+                     posted: Optional[Posted] = None) -> Optional[str]:
+    # Файлы, которые уже есть в этом чате, повторно не отправляются
+    items = [item for item in items if not item.skips(chat_id)]
+    if not items:
+        return None
+    if len(items) == 1:
+        return await forward_file(bot, chat_id, items[0], posted)
+    return await send_album(bot, chat_id, items, posted)
+
+
+def remember_posted(posted: Dict[int, Posted]):
+    for chat_id, messages in posted.items():
+        for (source_chat_id, message_id, file_unique_id), target_id in \
+                messages.items():
+            forward_index.add(source_chat_id, message_id, chat_id, target_id)
+            if dedup is not None and file_unique_id:
+                dedup.add(chat_id, file_unique_id, target_id)
+
+
+def record_posted(posted: Optional[Posted], item: QueueItem,
+                  target_message_id: int):
+    if posted is not None and item.message_id is not None:
+        key = (item.chat_id, item.message_id, item.file_unique_id)
+        posted[key] = target_message_id
+
+
+def log_delivery(items: List[QueueItem], results: Dict[int, Optional[str]]):
+    # Время от приёма первого сообщения до конца рассылки во все чаты
+    failed = sum(1 for error in results.values() if error)
+    if not failed:
+        outcome = "ok"
+    elif failed < len(results):
+        outcome = "partial"
+    else:
+        outcome = "failed"
+    item = items[0]
+    latency_ms = round((time.time() - item.created_at) * 1000, 1)
+    logger.info(
+        f"Доставка ({len(items)} шт.) от {item.sender_name}: {outcome}, "
+        f"{latency_ms} мс",
+        extra={"sender_id": item.sender_id, "chat_id": item.chat_id,
+               "media_group_id": item.media_group_id,
+               "latency_ms": latency_ms, "outcome": outcome})
+
+
+def success_text(items: List[QueueItem]) -> str:
+    if all(item.skip_chats == SKIP_ALL for item in items):
+        return duplicate_text(items)
+    if items[0].text:
+        if len(items) > 1:
+            return f"✅ Сообщения ({len(items)} шт.) успешно отправлены!"
+        return "✅ Сообщение успешно отправлено!"
+    if len(items) > 1:
+        return f"✅ Альбом ({len(items)} шт.) успешно отправлен!"
+    return "✅ Файл успешно отправлен!"
+
+
+def duplicate_text(items: List[QueueItem]) -> str:
+    if len(items) > 1:
+        return f"♻️ Альбом ({len(items)} шт.) уже был отправлен недавно."
+    item = items[0]
+    earlier = dedup.lookup(CHAT_IDS, item.file_unique_id)
+    if len(earlier) < len(CHAT_IDS) and dedup.is_pending(item.file_unique_id):
+        return "♻️ Этот файл уже принят и скоро будет отправлен."
+    links = [message_link(chat_id, message_id)
+             for chat_id, message_id in earlier.items()]
+    links = [link for link in links if link]
+    return ("♻️ Этот файл уже был отправлен недавно"
+            + (":\n" + "\n".join(links) if links else "."))
+
+
+async def deliver_remote(bot: Bot, items: List[QueueItem]):
+    # Целевой чат всегда обслуживает один и тот же процесс,
+    # поэтому порядок сообщений в каждом чате сохраняется
+    targets = {}
+    for position, chat_id in enumerate(CHAT_IDS):
+        targets.setdefault(position % worker_pool.size, []).append(chat_id)
+    parts = [(worker_pool.submit(index, (items, chat_ids)), chat_ids)
+             for index, chat_ids in targets.items()]
+    results = {}
+    for future, chat_ids in parts:
+        try:
+            part = await future
+        except WorkerDied as e:
+            # Что процесс успел отправить до падения, неизвестно: задание
+            # сохраняется в недоставленные, их можно отправить повторно
+            logger.error(f"Ошибка доставки: {e}")
+            for chat_id in chat_ids:
+                await dead_letter(chat_id, items, RetryError(e, EXHAUSTED, 1))
+                results[chat_id] = ("❌ Ошибка при пересылке. "
+                                    "Сообщение не отправлено.")
+            continue
+        if part is None:
+            results.update({chat_id: "❌ Ошибка при пересылке. "
+                                     "Сообщение не отправлено."
+                            for chat_id in chat_ids})
+            continue
+        errors, posted = part
+        results.update(errors)
+        remember_posted(posted)
+    log_delivery(items, results)
+    await report(bot, items, results)
+
+
+def delivery_process(index: int, jobs, results):
+    asyncio.run(serve_delivery(index, jobs, results))
+
+
+async def serve_delivery(index: int, jobs, results):
+    global fanout_semaphore
+    fanout_semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+    logger.info(f"Процесс доставки {index} запущен")
+    dead_letters.open()
+    if loop_monitor is not None:
+        loop_monitor.start()
+    try:
+        async with make_bot() as bot:
+            if HTTP_WARM_CONNECTIONS:
+                await bot.session.warm_up(bot, HTTP_WARM_CONNECTIONS)
+            # Отправки разных отправителей идут параллельно, как в
+            # процессе приёма; в каждом чате сообщения одного
+            # отправителя уходят по порядку
+            await serve_jobs(
+                jobs, results,
+                lambda payload: send_job(bot, payload[0], payload[1]),
+                keys=lambda payload: [(chat_id, payload[0][0].sender_id)
+                                      for chat_id in payload[1]],
+                limit=DELIVERY_WORKERS)
+    finally:
+        if loop_monitor is not None:
+            await loop_monitor.stop()
+        dead_letters.close()
+
+
+async def fan_out(
+    send: Callable[[int], Awaitable[Optional[str]]],
+    chat_ids: Optional[List[int]] = None,
+) -> Dict[int, Optional[str]]:
+    # Рассылка во все целевые чаты; ошибка в одном не мешает остальным
+    async def send_to(chat_id: int) -> Optional[str]:
+        with watch_slow("Отправка", SLOW_SEND_MS / 1000, f" в {chat_id}"):
+            async with fanout_semaphore:
+                try:
+                    return await send(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке в {chat_id}: {e}")
+                    return ("❌ Ошибка при пересылке. "
+                            "Сообщение не отправлено.")
+
+    chat_ids = CHAT_IDS if chat_ids is None else chat_ids
+    errors = await asyncio.gather(*(send_to(c) for c in chat_ids))
+    return dict(zip(chat_ids, errors))
+
+
+async def report(bot: Bot, items: List[QueueItem],
+                 results: Dict[int, Optional[str]]):
+    item = items[-1]
+    failed = {chat_id: error for chat_id, error in results.items() if error}
+    if not failed:
+        await acknowledge(bot, items)
+    elif len(results) == 1:
+        await notify(bot, item, next(iter(failed.values())))
+    else:
+        lines = [f"⚠️ Доставлено в {len(results) - len(failed)} "
+                 f"из {len(results)} чатов."]
+        lines += [f"{chat_id}: {error}" for chat_id, error in failed.items()]
+        await notify(bot, item, "\n".join(lines))
+
+
+async def acknowledge(bot: Bot, items: List[QueueItem]):
+    # Об ошибках отправитель узнаёт всегда, об успехе - по ACK_MODE
+    item = items[-1]
+    if ACK_MODE == "errors":
+        return
+    if ACK_MODE == "reaction":
+        await react(bot, item)
+    elif ack_scheduler is not None:
+        ack_scheduler.add(item.chat_id, ("ack", item.sender_id), items)
+    else:
+        await notify(bot, item, success_text(items))
+
+
+async def react(bot: Bot, item: QueueItem):
+    try:
+        await retry(
+            lambda: bot.set_message_reaction(
+                item.chat_id, item.message_id,
+                reaction=[ReactionTypeEmoji(emoji=ACK_REACTION)]),
+            notify_retry, f"Реакция для {item.chat_id}")
+    except RetryError as e:
+        logger.warning(f"Не удалось поставить реакцию: {e.error}")
+
+
+def send_summary(jobs: List[List[QueueItem]]):
+    task = asyncio.create_task(
+        notify(ack_bot, jobs[-1][-1], summary_text(jobs)))
+    ack_tasks.add(task)
+    task.add_done_callback(ack_tasks.discard)
+
+
+def summary_text(jobs: List[List[QueueItem]]) -> str:
+    if len(jobs) == 1:
+        return success_text(jobs[0])
+    texts = sum(len(job) for job in jobs if job[0].text)
+    files = sum(len(job) for job in jobs if not job[0].text)
+    parts = []
+    if texts:
+        parts.append(f"сообщений: {texts}")
+    if files:
+        parts.append(f"файлов: {files}")
+    return f"✅ Всё доставлено ({', '.join(parts)})"
+
+
+def merge_texts(items: List[QueueItem]) -> List[QueueItem]:
+    # Склеиваем тексты в сообщения, не выходя за лимит длины
+    batches = [[items[0]]]
+    for item in items[1:]:
+        candidate = batches[-1] + [item]
+        if len(make_caption(item.sender_name, join_texts(candidate))) > \
+                TEXT_MESSAGE_LIMIT:
+            batches.append([item])
+        else:
+            batches[-1] = candidate
+    merged = []
+    for batch in batches:
+        last = batch[-1]
+        # У склеенного сообщения нет одного исходного, править его нельзя
+        merged.append(QueueItem(
+            chat_id=last.chat_id,
+            message_id=last.message_id if len(batch) == 1 else None,
+            sender_id=last.sender_id, sender_name=last.sender_name,
+            text=join_texts(batch)))
+    return merged
+
+
+async def send_texts(bot: Bot, chat_id: int, batches: List[QueueItem],
+                     posted: Optional[Posted] = None) -> Optional[str]:
+    for batch in batches:
+        error = await forward_file(bot, chat_id, batch, posted)
+        if error:
+            return error
+    return None
+
+
+def join_texts(items: List[QueueItem]) -> str:
+    return "\n".join(item.text.strip() for item in items)
 
 
 def is_real_command(text: str) -> bool:
@@ -84,160 +848,258 @@ def is_allowed_file(file_name: str) -> Optional[str]:
     return None
 
 
-def make_caption(user, user_caption: Optional[str] = None) -> str:
+def make_caption(sender_name: str, user_caption: Optional[str] = None) -> str:
     if user_caption and user_caption.strip():
-        return f"💬 {user_caption.strip()} - от {user.full_name}"
-    return f"🖼️ Фото/Видео - от {user.full_name}"
+        return f"💬 {user_caption.strip()} - от {sender_name}"
+    return f"🖼️ Фото/Видео - от {sender_name}"
 
 
-async def forward_file(bot: Bot, chat_id: int,
-                       file_type: Optional[str], file_id: Optional[str],
-                       caption: Optional[str],
-                       is_document: bool = False,
-                       user=None, text_message: Optional[str] = None,
-                       msg: Optional[Message] = None):
-    # Текстовое сообщение
-    if text_message:
-        text_to_send = make_caption(user, text_message)
-        try:
-            await bot.send_message(chat_id, text_to_send)
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка при пересылке текста: {e}")
-            if msg:
-                await msg.reply("❌ Ошибка при пересылке текста. "
-                                "Сообщение не отправлено.")
-            return False
+def make_item(msg: Message, **fields) -> QueueItem:
+    # Всё, что нужно для доставки и ответа, без ссылки на сам Message
+    return QueueItem(
+        chat_id=msg.chat.id,
+        message_id=msg.message_id,
+        sender_id=msg.from_user.id,
+        sender_name=msg.from_user.full_name,
+        media_group_id=msg.media_group_id,
+        **fields,
+    )
 
-    final_caption = make_caption(user, caption)
 
-    # Повторные попытки до 3 раз при RetryAfter
-    for attempt in range(3):
-        try:
-            if file_type == "photo":
-                if not is_document:
-                    await bot.send_photo(
-                        chat_id, file_id, caption=final_caption)
-                else:
-                    await bot.send_document(
-                        chat_id, file_id, caption=final_caption)
-            elif file_type == "video":
-                if not is_document:
-                    await bot.send_video(
-                        chat_id, file_id, caption=final_caption)
-                else:
-                    await bot.send_document(
-                        chat_id, file_id, caption=final_caption)
-            return True
-        except TelegramRetryAfter as e:
-            logger.warning(
-                f"Флуд-контроль: жду {e.retry_after} "
-                f"сек. (попытка {attempt+1})")
-            await asyncio.sleep(e.retry_after)
-        except TelegramForbiddenError:
-            logger.error("Бот потерял доступ к чату")
-            if msg:
-                await msg.reply("❌ Бот потерял доступ к целевому чату. "
-                                "Отправка невозможна.")
-            return False
-        except TelegramBadRequest as e:
-            logger.error(f"Неверный запрос Telegram: {e}")
-            if msg:
-                await msg.reply("❌ Ошибка при отправке. Возможно, "
-                                "файл повреждён или формат не поддерживается.")
-            return False
-        except Exception as e:
-            logger.error(f"Ошибка при отправке {file_type}: {e}")
-            if msg:
-                await msg.reply("❌ Ошибка при пересылке. "
-                                "Сообщение не отправлено.")
-            return False
-    return False
-
-
-async def schedule_album_send(chat_id: int, media_group_id, msg, delay=5):
-    if chat_id not in album_timers:
-        album_timers[chat_id] = {}
-    if media_group_id in album_timers[chat_id]:
-        album_timers[chat_id][media_group_id].cancel()
-    album_timers[chat_id][media_group_id] = asyncio.create_task(
-        wait_and_send(chat_id, media_group_id, msg, delay)
-    )
+async def notify(bot: Bot, item: QueueItem, text: str):
+    # Ответ пользователю на исходное сообщение по его id
+    try:
+        await retry(
+            lambda: bot.send_message(
+                item.chat_id, text,
+                reply_parameters=ReplyParameters(
+                    message_id=item.message_id,
+                    allow_sending_without_reply=True)),
+            notify_retry, f"Ответ пользователю {item.chat_id}")
+    except RetryError as e:
+        logger.warning(f"Не удалось уведомить пользователя: {e.error}")
 
 
-async def wait_and_send(chat_id: int, media_group_id, msg, delay):
-    await asyncio.sleep(delay)
-    await send_album(chat_id, media_group_id, msg)
-    album_timers[chat_id].pop(media_group_id, None)
+async def dead_letter(chat_id: int, items: List[QueueItem],
+                      error: RetryError):
+    # Битые файлы повторять бессмысленно, сохраняем только то,
+    # что может пройти позже (закончились повторы, пропал доступ к чату)
+    if error.kind == PERMANENT:
+        return
+    DEAD_LETTERS.inc(kind=error.kind)
+    letter_id = await dead_letters.add(
+        chat_id, items, str(error.error), error.kind, error.attempts)
+    logger.error(f"Не доставлено в {chat_id} ({len(items)} шт.) после "
+                 f"{error.attempts} попыток, запись #{letter_id}")
 
 
-# Очистка старых альбомов
-async def send_album(chat_id: int, media_group_id, msg: Message):
+def failure_text(error: RetryError) -> str:
+    if isinstance(error.error, TelegramForbiddenError):
+        return ("❌ Бот потерял доступ к целевому чату. "
+                "Отправка невозможна.")
+    if isinstance(error.error, TelegramBadRequest):
+        return ("❌ Ошибка при отправке. Возможно, "
+                "файл повреждён или формат не поддерживается.")
+    return "❌ Ошибка при пересылке. Сообщение не отправлено."
 
-    cleanup_old_albums()
 
-    items = media_buffer.get(chat_id, {}).pop(media_group_id, [])
-    if not items:
+async def forward_file(bot: Bot, chat_id: int, item: QueueItem,
+                       posted: Optional[Posted] = None
+                       ) -> Optional[str]:
+    # Возвращает текст ошибки для пользователя или None при успехе
+    # Текстовое сообщение
+    if item.text:
+        text_to_send = make_caption(item.sender_name, item.text)
+        try:
+            sent = await retry(
+                lambda: bot.send_message(chat_id, text_to_send),
+                send_retry, f"Текст в {chat_id}")
+            record_posted(posted, item, sent.message_id)
+            return None
+        except RetryError as e:
+            logger.error(
+                f"Ошибка при пересылке текста в {chat_id}: {e.error}")
+            await dead_letter(chat_id, [item], e)
+            return ("❌ Ошибка при пересылке текста. "
+                    "Сообщение не отправлено.")
+
+    try:
+        await send_file(bot, chat_id, item, posted)
+    except RetryError as e:
+        log_file_error(chat_id, item, e)
+        await dead_letter(chat_id, [item], e)
+        return failure_text(e)
+    return None
+
+
+async def send_file(bot: Bot, chat_id: int, item: QueueItem,
+                    posted: Optional[Posted] = None):
+    # Отправка файла с повторами; если не удалась - RetryError
+    file_type = item.file_type
+    file_id = item.file_id
+    final_caption = make_caption(item.sender_name, item.caption)
+    if item.is_document:
+        send = bot.send_document
+    elif file_type == "photo":
+        send = bot.send_photo
+    elif file_type == "video":
+        send = bot.send_video
+    else:
         return
 
-    for i in range(0, len(items), MEDIA_GROUP_LIMIT):
-        chunk = items[i:i + MEDIA_GROUP_LIMIT]
-        media = []
-        for j, (file_type, file_id, caption,
-                msg_item, is_document) in enumerate(chunk):
-            if caption and caption.strip():
-                cap = make_caption(msg_item.from_user, caption)
-            else:
-                if not is_document and j == 0:
-                    cap = make_caption(msg_item.from_user)
-                elif is_document and j == len(chunk) - 1:
-                    cap = make_caption(msg_item.from_user)
-                else:
-                    cap = None
-
-            if file_type == "photo":
-                media.append(InputMediaPhoto(media=file_id, caption=cap)
-                             if not is_document else
-                             InputMediaDocument(media=file_id, caption=cap))
-            elif file_type == "video":
-                media.append(InputMediaVideo(media=file_id, caption=cap)
-                             if not is_document else
-                             InputMediaDocument(media=file_id, caption=cap))
+    sent = await retry(
+        lambda: send(chat_id, file_id, caption=final_caption),
+        send_retry, f"Файл в {chat_id}")
+    record_posted(posted, item, sent.message_id)
+
+
+def log_file_error(chat_id: int, item: QueueItem, e: RetryError):
+    if isinstance(e.error, TelegramForbiddenError):
+        logger.error(f"Бот потерял доступ к чату {chat_id}")
+    elif isinstance(e.error, TelegramBadRequest):
+        logger.error(f"Неверный запрос Telegram: {e.error}")
+    else:
+        logger.error(f"Ошибка при отправке {item.file_type}: {e.error}")
 
+
+async def send_album(bot: Bot, chat_id: int, items: List[QueueItem],
+                     posted: Optional[Posted] = None
+                     ) -> Optional[str]:
+    failed = []
+    groups = plan_groups(items, MEDIA_GROUP_LIMIT)
+    for index, chunk in enumerate(groups):
+        # Группа из одного файла недопустима, он уходит отдельно
+        if len(chunk) == 1:
+            if await forward_file(bot, chat_id, chunk[0], posted):
+                failed += chunk
+            continue
+        # Часть альбома повторяется целиком, пока не пройдёт
         try:
-            await msg.bot.send_media_group(CHAT_ID, media=media)
-        except TelegramRetryAfter as e:
-            logger.warning(f"Флуд-контроль (альбом): жду {e.retry_after} сек.")
-            await asyncio.sleep(e.retry_after)
-        except Exception as e:
-            logger.error(f"Ошибка при пересылке альбома: {e}")
+            await send_group(bot, chat_id, chunk, posted)
+        except RetryError as e:
+            if e.kind != PERMANENT:
+                logger.error(
+                    f"Ошибка при пересылке альбома в {chat_id}: {e.error}")
+                # Эта и все следующие части не отправлены
+                await dead_letter(
+                    chat_id, [item for group in groups[index:]
+                              for item in group], e)
+                return ("❌ Ошибка при отправке альбома. "
+                        "Сообщения не отправлены.")
+            # Telegram отклоняет часть целиком из-за одного битого файла
+            logger.warning(f"Альбом в {chat_id} отклонён ({e.error}), "
+                           f"ищу файлы с ошибкой")
             try:
-                await msg.reply("❌ Ошибка при отправке альбома. "
-                                "Сообщения не отправлены.")
-            except Exception as err:
-                logger.warning(
-                    f"Не удалось уведомить пользователя об ошибке: {err}")
-            return
+                failed += await bisect_album(bot, chat_id, chunk, posted)
+            except RetryError as stop:
+                # Неотправленный остаток этой части уже сохранён при поиске
+                logger.error(
+                    f"Ошибка при пересылке альбома в {chat_id}: {stop.error}")
+                rest = [item for group in groups[index + 1:]
+                        for item in group]
+                if rest:
+                    await dead_letter(chat_id, rest, stop)
+                return ("❌ Ошибка при отправке альбома. "
+                        "Сообщения не отправлены.")
 
-    await msg.reply(f"✅ Альбом ({len(items)} шт.) успешно отправлен!")
+    if failed:
+        return album_failure_text(items, failed)
     logger.info(
-        f"Альбом ({len(items)} шт.) от {msg.from_user.full_name} "
-        f"({msg.from_user.id}) → {CHAT_ID}")
+        f"Альбом ({len(items)} шт.) от {items[-1].sender_name} "
+        f"({items[-1].sender_id}) → {chat_id}")
+    return None
+
+
+def album_media(chunk: List[QueueItem]) -> list:
+    media = []
+    for j, item in enumerate(chunk):
+        caption = item.caption
+        is_document = item.is_document
+        if caption and caption.strip():
+            cap = make_caption(item.sender_name, caption)
+        else:
+            if not is_document and j == 0:
+                cap = make_caption(item.sender_name)
+            elif is_document and j == len(chunk) - 1:
+                cap = make_caption(item.sender_name)
+            else:
+                cap = None
+
+        file_id = item.file_id
+        if item.file_type == "photo":
+            media.append(InputMediaPhoto(media=file_id, caption=cap)
+                         if not is_document else
+                         InputMediaDocument(media=file_id, caption=cap))
+        elif item.file_type == "video":
+            media.append(InputMediaVideo(media=file_id, caption=cap)
+                         if not is_document else
+                         InputMediaDocument(media=file_id, caption=cap))
+    return media
+
+
+async def send_group(bot: Bot, chat_id: int, chunk: List[QueueItem],
+                     posted: Optional[Posted] = None):
+    media = album_media(chunk)
+    sent = await retry(
+        lambda: bot.send_media_group(chat_id, media=media),
+        send_retry, f"Альбом в {chat_id}")
+    for item, message in zip(chunk, sent):
+        record_posted(posted, item, message.message_id)
+
+
+async def bisect_album(bot: Bot, chat_id: int, chunk: List[QueueItem],
+                       posted: Optional[Posted] = None
+                       ) -> List[QueueItem]:
+    # Делим отклонённую часть пополам, пока не останутся отдельные
+    # файлы: исправные уходят группами, битые - возвращаются. Прочие
+    # ошибки поиском не исправить: неотправленный остаток части
+    # сохраняется в недоставленные, а RetryError уходит выше
+    half = (len(chunk) + 1) // 2
+    parts = [chunk[:half], chunk[half:]]
+    failed = []
+    for index, part in enumerate(parts):
+        try:
+            failed += await bisect_part(bot, chat_id, part, posted)
+        except RetryError as e:
+            rest = [item for later in parts[index + 1:] for item in later]
+            if rest:
+                await dead_letter(chat_id, rest, e)
+            raise
+    return failed
+
+
+async def bisect_part(bot: Bot, chat_id: int, part: List[QueueItem],
+                      posted: Optional[Posted] = None
+                      ) -> List[QueueItem]:
+    try:
+        if len(part) == 1:
+            await send_file(bot, chat_id, part[0], posted)
+        else:
+            await send_group(bot, chat_id, part, posted)
+        return []
+    except RetryError as e:
+        if e.kind == PERMANENT and len(part) > 1:
+            return await bisect_album(bot, chat_id, part, posted)
+        await dead_letter(chat_id, part, e)
+        if e.kind != PERMANENT:
+            raise
+        log_file_error(chat_id, part[0], e)
+        return part
 
 
-def cleanup_old_albums(ttl_seconds: int = 120):
-    now = datetime.now()
-    for chat_id, groups in list(media_buffer.items()):
-        for media_group_id, items in list(groups.items()):
-            if not items:
-                continue
-            first_msg_time = datetime.fromtimestamp(
-                items[0][3].date.timestamp())
-            if now - first_msg_time > timedelta(seconds=ttl_seconds):
-                logger.info(
-                    f"Очищен старый альбом: chat_id={chat_id}, "
-                    f"media_group_id={media_group_id}")
-                groups.pop(media_group_id, None)
+def album_failure_text(items: List[QueueItem],
+                       failed: List[QueueItem]) -> str:
+    kinds = {"photo": "фото", "video": "видео"}
+    positions = {id(item): number for number, item in enumerate(items, 1)}
+    files = ", ".join(
+        f"№{positions[id(item)]} {kinds.get(item.file_type, 'файл')}"
+        for item in failed)
+    if len(failed) == len(items):
+        return ("❌ Ошибка при отправке альбома. Сообщения не отправлены "
+                f"({files}).")
+    return (f"⚠️ Альбом отправлен частично: не удалось отправить "
+            f"{len(failed)} из {len(items)} файлов ({files}). Возможно, "
+            f"они повреждены или формат не поддерживается.")
 
 
 @dp.message(Command("start"))
@@ -262,23 +1124,19 @@ async def handle_media(msg: Message):
 
     # Текстовое сообщение, не команда
     if msg.text and not is_real_command(msg.text):
-        success = await forward_file(
-            msg.bot, CHAT_ID, None, None, None, user=msg.from_user,
-            text_message=msg.text, msg=msg
-        )
-        if success:
-            await msg.reply("✅ Сообщение успешно отправлено!")
+        item = make_item(msg, text=msg.text)
+        await outbox.put(item)
+        accept_item(item)
+        inflight.add()
+        if text_scheduler is not None:
+            text_scheduler.add(chat_id, ("text", item.sender_id), item)
+        else:
+            delivery_queue.put_nowait([item])
         return
 
-    media_group_id = msg.media_group_id or msg.message_id
-
-    if chat_id not in media_buffer:
-        media_buffer[chat_id] = {}
-    if media_group_id not in media_buffer[chat_id]:
-        media_buffer[chat_id][media_group_id] = []
-
     file_type = None
     file_id = None
+    file_unique_id = None
     file_size = 0
     caption = msg.caption
     is_document = False
@@ -286,10 +1144,12 @@ async def handle_media(msg: Message):
     if msg.photo:
         file_type = "photo"
         file_id = msg.photo[-1].file_id
+        file_unique_id = msg.photo[-1].file_unique_id
         file_size = msg.photo[-1].file_size
     elif msg.video:
         file_type = "video"
         file_id = msg.video.file_id
+        file_unique_id = msg.video.file_unique_id
         file_size = msg.video.file_size
     elif msg.document:
         kind = is_allowed_file(msg.document.file_name)
@@ -300,6 +1160,7 @@ async def handle_media(msg: Message):
             return
         file_type = kind
         file_id = msg.document.file_id
+        file_unique_id = msg.document.file_unique_id
         file_size = msg.document.file_size
         is_document = True
     else:
@@ -315,54 +1176,350 @@ async def handle_media(msg: Message):
             f"Отклонён большой файл: {file_type}, размер {file_size}")
         return
 
-    media_buffer[chat_id][media_group_id].append(
-        (file_type, file_id, caption, msg, is_document)
-    )
+    # Файл уже есть в части целевых чатов - туда он не отправляется.
+    # Повтор, которому некуда идти, проходит очередь без отправки, чтобы
+    # ответ отправителю шёл по ACK_MODE и один на альбом
+    skip_chats = None
+    if dedup is not None:
+        earlier = dedup.lookup(CHAT_IDS, file_unique_id)
+        if len(earlier) == len(CHAT_IDS) or dedup.is_pending(file_unique_id):
+            DEDUP_HITS.inc()
+            DEDUP_SAVED_CALLS.inc(len(CHAT_IDS))
+            skip_chats = SKIP_ALL
+            logger.info(f"Пропущен повтор файла {file_unique_id} "
+                        f"от {msg.from_user.full_name}")
+        else:
+            if earlier:
+                DEDUP_SAVED_CALLS.inc(len(earlier))
+                skip_chats = ",".join(str(chat_id) for chat_id in earlier)
+            dedup.mark_pending(file_unique_id)
+
+    item = make_item(msg, file_type=file_type, file_id=file_id,
+                     file_unique_id=file_unique_id,
+                     caption=caption, is_document=is_document,
+                     skip_chats=skip_chats)
+    if skip_chats != SKIP_ALL:
+        # Вебхук отвечает Telegram только после записи на диск; в long
+        # polling обновление подтверждается следующим getUpdates, который
+        # может уйти раньше, чем запись завершится
+        try:
+            await outbox.put(item)
+        except BaseException:
+            if dedup is not None:
+                dedup.clear_pending(file_unique_id)
+            raise
+        accept_item(item)
+    inflight.add()
+
+    # Накопленные тексты отправителя уходят раньше его файлов
+    if text_scheduler is not None:
+        text_scheduler.flush(chat_id, ("text", item.sender_id))
 
     if msg.media_group_id:
-        await schedule_album_send(chat_id, media_group_id, msg)
+        album_scheduler.add(chat_id, msg.media_group_id, item)
     else:
-        file_type, file_id, caption, msg_item, is_document = (
-            media_buffer[chat_id].pop(media_group_id)[0]
-        )
-        success = await forward_file(
-            msg.bot, CHAT_ID, file_type,
-            file_id, caption, is_document, msg_item.from_user, msg=msg
-        )
-        if success:
-            await msg.reply("✅ Файл успешно отправлен!")
+        delivery_queue.put_nowait([item])
 
 
 @dp.edited_message()
 async def handle_edit(msg: Message):
-    if msg.text and not is_real_command(msg.text):
-        try:
-            await msg.bot.send_message(
-                CHAT_ID,
-                f"✏️ (Внес исправления)\n\n"
-                f"{make_caption(msg.from_user, msg.text)}"
-            )
-            logger.info(
-                f"Редактированное сообщение от "
-                f"{msg.from_user.full_name} → {CHAT_ID}")
-        except Exception as e:
-            logger.error(
-                f"Ошибка при пересылке редактированного сообщения: {e}")
+    sender_name = msg.from_user.full_name
+    if msg.text:
+        if is_real_command(msg.text):
+            return
+        text = make_caption(sender_name, msg.text)
+
+        def edit(chat_id: int, message_id: int):
+            return msg.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=message_id)
+    elif msg.photo or msg.video or msg.document:
+        text = make_caption(sender_name, msg.caption)
+
+        def edit(chat_id: int, message_id: int):
+            return msg.bot.edit_message_caption(
+                caption=text, chat_id=chat_id, message_id=message_id)
+    else:
+        return
+
+    # Оригинал ещё не отправлен: уйдёт сразу исправленным
+    key = (msg.chat.id, msg.message_id)
+    item = queued_items.get(key)
+    if item is not None:
+        if item.text is not None:
+            item.text = msg.text
+        else:
+            item.caption = msg.caption
+        outbox.update(item)
+        logger.info(f"Исправление от {sender_name} учтено до отправки")
+        return
+    # Оригинал отправляется: правим копию, когда она появится
+    sending = sending_items.get(key)
+    if sending is not None:
+        await sending.wait()
+
+    forwarded = forward_index.get(msg.chat.id, msg.message_id)
+
+    async def send_edit(chat_id: int) -> Optional[str]:
+        message_id = forwarded.get(chat_id)
+        if message_id:
             try:
-                await msg.reply("❌ Ошибка при редактировании сообщения.")
-            except Exception as err:
-                logger.warning(
-                    f"Не удалось уведомить пользователя об ошибке: {err}")
+                await retry(lambda: edit(chat_id, message_id),
+                            send_retry, f"Исправление в {chat_id}")
+                logger.info(f"Исправлено сообщение от {sender_name} "
+                            f"→ {chat_id}")
+                return None
+            except RetryError as e:
+                if "message is not modified" in str(e.error):
+                    return None
+                logger.warning(f"Не удалось исправить сообщение "
+                               f"{message_id} в {chat_id}: {e.error}")
+        # Копии нет или её нельзя изменить - отправляем новое сообщение
+        sent = await retry(
+            lambda: msg.bot.send_message(
+                chat_id, f"✏️ (Внес исправления)\n\n{text}"),
+            send_retry, f"Исправление в {chat_id}")
+        if msg.text:
+            forward_index.add(msg.chat.id, msg.message_id,
+                              chat_id, sent.message_id)
+        logger.info(
+            f"Редактированное сообщение от {sender_name} → {chat_id}")
+        return None
+
+    results = await fan_out(send_edit)
+    if any(results.values()):
+        try:
+            await msg.reply("❌ Ошибка при редактировании сообщения.")
+        except Exception as err:
+            logger.warning(
+                f"Не удалось уведомить пользователя об ошибке: {err}")
+
+
+async def run_polling(bot: Bot, stop: asyncio.Event):
+    # getUpdates не работает, пока у бота зарегистрирован вебхук
+    await bot.delete_webhook()
+    # Сигналы обрабатывает main(): опрос прекращается, затем on_shutdown
+    # дожидается доставки уже принятых сообщений
+    allowed_updates = dp.resolve_used_update_types()
+    logger.info(f"Long polling: ожидание {POLLING_TIMEOUT_SEC} сек., "
+                f"до {POLLING_LIMIT} обновлений за раз, типы: "
+                f"{', '.join(allowed_updates)}")
+    polling = asyncio.create_task(dp.start_polling(
+        bot, handle_signals=False, polling_timeout=POLLING_TIMEOUT_SEC,
+        allowed_updates=allowed_updates,
+        # Пока обработка не успевает, следующая пачка не запрашивается
+        tasks_concurrency_limit=HANDLER_CONCURRENCY + POLLING_LIMIT
+        if HANDLER_CONCURRENCY else None))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait((polling, stopping),
+                       return_when=asyncio.FIRST_COMPLETED)
+    stopping.cancel()
+    if not polling.done():
+        await dp.stop_polling()
+    await polling
+
+
+async def run_webhook(bot: Bot, stop: asyncio.Event):
+    app = web.Application()
+    # Хуки остановки выполняются по порядку: доставка должна завершиться
+    # раньше, чем обработчик вебхука закроет сессию бота
+    setup_application(app, dp, bot=bot)
+    # Ответ 200 уходит после обработчика, то есть после записи в очередь
+    # на диске: если бот упадёт раньше, Telegram пришлёт обновление снова
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET,
+        handle_in_background=False,
+    ).register(app, path=WEBHOOK_PATH)
+
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Вебхук зарегистрирован: "
+                    f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+    else:
+        # Без внешнего адреса сервер принимает обновления только локально
+        logger.info("WEBHOOK_BASE_URL не задан, вебхук в Telegram "
+                    "не регистрируется")
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}"
+                f"{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        # Сервер сначала перестаёт принимать запросы, затем on_shutdown
+        # дожидается доставки уже принятых сообщений
+        await runner.cleanup()
+
+
+def api_server() -> TelegramAPIServer:
+    if not BOT_API_URL:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL)
+
+
+def make_bot() -> Bot:
+    # Общий лимит делится между процессом приёма и процессами доставки,
+    # которым достались целевые чаты
+    scheduler = SendScheduler(
+        global_rate=RATE_GLOBAL_PER_SEC / (DELIVERY_PROCESSES + 1),
+        group_per_minute=RATE_GROUP_PER_MIN,
+        private_rate=RATE_PRIVATE_PER_SEC,
+    )
+    session = TunedAiohttpSession(
+        api=api_server(),
+        limit=HTTP_POOL_SIZE,
+        keepalive_timeout=HTTP_KEEPALIVE_SEC,
+        dns_ttl=HTTP_DNS_TTL_SEC,
+        timeout=HTTP_TIMEOUT_SEC,
+        media_timeout=HTTP_MEDIA_TIMEOUT_SEC,
+        video_timeout=HTTP_VIDEO_TIMEOUT_SEC,
+    )
+    bot = Bot(token=BOT_TOKEN, session=session)
+    bot.session.middleware(RequestMetricsMiddleware())
+    bot.session.middleware(RateLimitMiddleware(scheduler))
+    bot.session.middleware(UpdatesLimitMiddleware(POLLING_LIMIT))
+    return bot
+
+
+def reload_settings():
+    # SIGHUP: перечитать .env без перезапуска и без потери буферов.
+    # Пути, режим работы, пул соединений и процессы доставки
+    # меняются только перезапуском
+    global CHAT_ID, CHAT_IDS, MAX_FILE_SIZE, INFLIGHT_LIMIT
+    global SENDER_RATE_PER_MIN, SENDER_BURST, SENDER_MAX_DELAY_SEC
+    global SENDER_MAX_QUEUED, DOTENV_KEYS
+    values = {key: value for key, value in dotenv_values().items()
+              if key not in ENVIRON_KEYS and value is not None}
+    # Строки, удалённые из .env, возвращают значения по умолчанию
+    for key in DOTENV_KEYS - set(values):
+        os.environ.pop(key, None)
+    os.environ.update(values)
+    DOTENV_KEYS = set(values)
+    try:
+        chat_id = os.getenv("CHAT_ID", "")
+        chat_ids = parse_chat_ids(chat_id)
+        if not chat_ids:
+            raise ValueError("CHAT_ID не найден в .env")
+        file_size = max_file_size()
+        sender_rate = float(os.getenv("SENDER_RATE_PER_MIN", "0"))
+        sender_burst = int(os.getenv("SENDER_BURST", "30"))
+        sender_max_delay = float(os.getenv("SENDER_MAX_DELAY_SEC", "30"))
+        sender_max_queued = int(os.getenv("SENDER_MAX_QUEUED", "0"))
+        inflight_limit = int(os.getenv("INFLIGHT_LIMIT", "1000"))
+    except ValueError as e:
+        logger.error(f"Настройки не перечитаны, действуют прежние: {e}")
+        return
+    CHAT_ID, CHAT_IDS, MAX_FILE_SIZE = chat_id, chat_ids, file_size
+    SENDER_RATE_PER_MIN, SENDER_BURST, SENDER_MAX_DELAY_SEC = (
+        sender_rate, sender_burst, sender_max_delay)
+    SENDER_MAX_QUEUED = sender_max_queued
+    INFLIGHT_LIMIT = inflight_limit
+    sender_limit.configure(SENDER_RATE_PER_MIN / 60, SENDER_BURST,
+                           SENDER_MAX_DELAY_SEC, SENDER_MAX_QUEUED)
+    inflight.limit = INFLIGHT_LIMIT
+    # При увеличенном лимите ожидающие обработчики продолжают сразу
+    inflight.done(0)
+    logger.info(f"Настройки перечитаны: чаты {CHAT_IDS}, максимальный "
+                f"размер файла {MAX_FILE_SIZE / 1024 / 1024:.0f} МБ")
+
+
+def install_signal_handlers(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    handlers = {"SIGTERM": stop.set, "SIGINT": stop.set,
+                "SIGHUP": reload_settings, "SIGUSR1": profiler.toggle}
+    for name, callback in handlers.items():
+        if not hasattr(signal, name):
+            continue
+        try:
+            loop.add_signal_handler(getattr(signal, name), callback)
+        except NotImplementedError:
+            # Windows: остановка по Ctrl+C без ожидания доставки
+            return
 
 
 async def main():
-    logger.info("Бот запущен...")
-    async with Bot(token=BOT_TOKEN) as bot:
-        await dp.start_polling(bot)
+    logger.info(f"Бот запущен в режиме {BOT_MODE}...")
+    if BOT_API_URL:
+        logger.info(f"Bot API: {BOT_API_URL}"
+                    f"{' (локальные файлы)' if BOT_API_LOCAL else ''}")
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(
+            METRICS_HOST, METRICS_PORT, is_ready)
+    stop = asyncio.Event()
+    install_signal_handlers(stop)
+    if loop_monitor is not None:
+        loop_monitor.start()
+    try:
+        async with make_bot() as bot:
+            if BOT_MODE == "webhook":
+                await run_webhook(bot, stop)
+            else:
+                await run_polling(bot, stop)
+    finally:
+        # Профиль, не выключенный до остановки, всё равно сохраняется
+        profiler.stop()
+        if loop_monitor is not None:
+            await loop_monitor.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+async def dead_letters_cli(args: List[str]):
+    # python main.py dead-letters [list|replay] [id ...]
+    global fanout_semaphore
+    command = args[0] if args else "list"
+    ids = [int(arg) for arg in args[1:]]
+    if command not in ("list", "replay"):
+        print("Использование: python main.py dead-letters "
+              "[list|replay] [id ...]")
+        return
+    dead_letters.open()
+    try:
+        letters = dead_letters.list(ids)
+        if command == "list":
+            for letter in letters:
+                kinds = ", ".join(sorted({item.file_type or "text"
+                                          for item in letter.items}))
+                print(f"#{letter.id} {time.ctime(letter.failed_at)} "
+                      f"→ {letter.chat_id}: {len(letter.items)} шт. "
+                      f"({kinds}) от {letter.items[0].sender_name}, "
+                      f"{letter.kind}, попыток {letter.attempts}: "
+                      f"{letter.error}")
+            print(f"Всего: {len(letters)}")
+            return
+        fanout_semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+        async with make_bot() as bot:
+            for letter in letters:
+                latest = dead_letters.last_id()
+                results, _ = await send_job(
+                    bot, letter.items, [letter.chat_id])
+                error = results[letter.chat_id]
+                # Запись удаляется после доставки или если неудачная
+                # отправка сохранилась новой записью; постоянные ошибки
+                # заново не сохраняются, и тогда запись остаётся
+                stored = dead_letters.last_id() != latest
+                if not error or stored:
+                    dead_letters.remove([letter.id])
+                note = f", сохранено как #{dead_letters.last_id()}" \
+                    if error and stored else ""
+                print(f"#{letter.id} → {letter.chat_id}: "
+                      f"{error or 'доставлено'}{note}")
+    finally:
+        dead_letters.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if sys.argv[1:2] == ["dead-letters"]:
+            asyncio.run(dead_letters_cli(sys.argv[2:]))
+        else:
+            asyncio.run(main())
     except Exception as e:
         logger.critical(f"Критическая ошибка: {e}")
@@ -0,0 +1,255 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware, NextRequestMiddlewareType)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self.values[()] = 0.0
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.warning(f"Не удалось получить метрику {self.name}: {e}")
+            return []
+        return [f"{self.name} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # Счётчики по корзинам + [сумма, количество] в конце
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0.0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        names = self.labelnames + ("le",)
+        for key, state in self.values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(names, key + (bound,))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket"
+                         f"{_format_labels(names, key + ('+Inf',))} "
+                         f"{state[-1]}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {state[-2]}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str,
+              callback: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+SEND_LATENCY = REGISTRY.register(Histogram(
+    "bot_send_latency_seconds",
+    "Время пересылки в целевой чат, включая ожидание лимитов",
+    ["path"]))
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Время обработки входящего обновления",
+    ["handler"]))
+RETRY_AFTER_TOTAL = REGISTRY.register(Counter(
+    "bot_retry_after_total", "Сколько раз Telegram ответил RetryAfter"))
+RETRY_AFTER_SECONDS = REGISTRY.register(Counter(
+    "bot_retry_after_seconds_total",
+    "Суммарная пауза, запрошенная Telegram через RetryAfter"))
+DEDUP_HITS = REGISTRY.register(Counter(
+    "bot_dedup_hits_total",
+    "Повторно присланные файлы, которые не пересылались"))
+DEDUP_SAVED_CALLS = REGISTRY.register(Counter(
+    "bot_dedup_saved_calls_total",
+    "Сколько отправок в целевые чаты сэкономил кэш дубликатов"))
+RETRIES = REGISTRY.register(Counter(
+    "bot_send_retries_total", "Повторные попытки отправки по типу ошибки",
+    ["exception"]))
+DEAD_LETTERS = REGISTRY.register(Counter(
+    "bot_dead_letters_total",
+    "Отправки, сохранённые как недоставленные, по причине", ["kind"]))
+THROTTLED = REGISTRY.register(Counter(
+    "bot_sender_throttled_total",
+    "Сообщения, задержанные или отклонённые лимитом на отправителя",
+    ["action"]))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "bot_event_loop_lag_seconds",
+    "Насколько позже срока цикл событий выполняет запланированное",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+             5.0)))
+LOOP_STALLS = REGISTRY.register(Counter(
+    "bot_event_loop_stalls_total",
+    "Сколько раз цикл событий был заблокирован дольше порога"))
+SLOW_CALLS = REGISTRY.register(Counter(
+    "bot_slow_calls_total",
+    "Обработчики и отправки, превысившие порог времени", ["name"]))
+ERRORS = REGISTRY.register(Counter(
+    "bot_errors_total", "Ошибки запросов к Bot API и обработчиков",
+    ["exception"]))
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Считает RetryAfter и ошибки всех исходящих запросов."""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType,
+                       bot: Bot, method: TelegramMethod):
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            RETRY_AFTER_TOTAL.inc()
+            RETRY_AFTER_SECONDS.inc(e.retry_after)
+            ERRORS.inc(exception=type(e).__name__)
+            raise
+        except Exception as e:
+            ERRORS.inc(exception=type(e).__name__)
+            raise
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время обработчиков сообщений."""
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None),
+                       "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            ERRORS.inc(exception=type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start,
+                                    handler=name)
+
+
+async def start_metrics_server(host: str, port: int,
+                               is_ready: Callable[[], bool]) -> web.AppRunner:
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            text=REGISTRY.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; "
+                                     "charset=utf-8"})
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def readyz(request: web.Request) -> web.Response:
+        if is_ready():
+            return web.Response(text="ready")
+        return web.Response(status=503, text="not ready")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
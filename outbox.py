@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = (
+    "chat_id", "message_id", "media_group_id", "sender_id", "sender_name",
+    "file_type", "file_id", "caption", "is_document", "text", "created_at",
+    "file_unique_id", "skip_chats",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    media_group_id TEXT,
+    sender_id INTEGER,
+    sender_name TEXT,
+    file_type TEXT,
+    file_id TEXT,
+    caption TEXT,
+    is_document INTEGER NOT NULL DEFAULT 0,
+    text TEXT,
+    created_at REAL NOT NULL,
+    file_unique_id TEXT,
+    skip_chats TEXT
+)
+"""
+
+# Колонки, добавленные после первой версии схемы
+MIGRATIONS = {
+    "file_unique_id": "ALTER TABLE outbox ADD COLUMN file_unique_id TEXT",
+    "skip_chats": "ALTER TABLE outbox ADD COLUMN skip_chats TEXT",
+}
+
+# skip_chats: файл уже есть во всех целевых чатах, отправлять нечего
+SKIP_ALL = "*"
+
+
+class QueueItem:
+    """Принятое сообщение: только поля, нужные для доставки и ответа."""
+
+    __slots__ = ("id",) + COLUMNS
+
+    def __init__(self, chat_id: int, message_id: int, sender_id: int,
+                 sender_name: str, media_group_id: Optional[str] = None,
+                 file_type: Optional[str] = None,
+                 file_id: Optional[str] = None,
+                 caption: Optional[str] = None, is_document: bool = False,
+                 text: Optional[str] = None,
+                 created_at: Optional[float] = None,
+                 file_unique_id: Optional[str] = None,
+                 skip_chats: Optional[str] = None,
+                 id: Optional[int] = None):
+        self.id = id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.sender_id = sender_id
+        # Имена и типы повторяются, храним по одной копии строки
+        self.sender_name = sys.intern(sender_name)
+        self.file_type = sys.intern(file_type) if file_type else None
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        # Целевые чаты через запятую, где файл уже есть
+        self.skip_chats = skip_chats
+        self.caption = caption
+        self.is_document = bool(is_document)
+        self.text = text
+        self.created_at = time.time() if created_at is None else created_at
+
+    def skips(self, chat_id: int) -> bool:
+        if not self.skip_chats:
+            return False
+        return self.skip_chats == SKIP_ALL or \
+            str(chat_id) in self.skip_chats.split(",")
+
+
+class Outbox:
+    """Очередь принятых сообщений на диске (SQLite в режиме WAL).
+
+    Запись группируется: put() ждёт общего коммита пачки, поэтому
+    при высокой нагрузке на диск уходит одна транзакция на много сообщений.
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.01,
+                 commit_batch: int = 200):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._db: Optional[sqlite3.Connection] = None
+        self._puts: List[Tuple[QueueItem, asyncio.Future]] = []
+        self._acks: List[int] = []
+        self._updates: List[QueueItem] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        existing = {row[1] for row in
+                    self._db.execute("PRAGMA table_info(outbox)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in existing:
+                self._db.execute(statement)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._puts or self._acks or self._updates:
+            await self._commit()
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def pending(self) -> List[QueueItem]:
+        # Недоставленные записи в порядке поступления
+        rows = self._db.execute(
+            f"SELECT id, {', '.join(COLUMNS)} FROM outbox ORDER BY id"
+        ).fetchall()
+        return [QueueItem(**dict(zip(("id",) + COLUMNS, row)))
+                for row in rows]
+
+    async def put(self, item: QueueItem) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._puts.append((item, future))
+        if len(self._puts) >= self.commit_batch and self._wakeup:
+            self._wakeup.set()
+        item.id = await future
+        return item.id
+
+    def ack(self, ids: List[int]):
+        # Удаление доставленных записей не требует ожидания коммита
+        self._acks.extend(i for i in ids if i is not None)
+
+    def update(self, item: QueueItem):
+        # Исправленные текст и подпись ещё не отправленного сообщения
+        if item.id is not None:
+            self._updates.append(item)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._puts or self._acks or self._updates:
+                await self._commit()
+
+    async def _commit(self):
+        puts, self._puts = self._puts, []
+        acks, self._acks = self._acks, []
+        updates, self._updates = self._updates, []
+        try:
+            ids = await asyncio.to_thread(
+                self._write, [item for item, _ in puts], acks, updates)
+        except Exception as e:
+            logger.error(f"Ошибка записи очереди на диск: {e}")
+            for _, future in puts:
+                if not future.done():
+                    future.set_exception(e)
+            self._acks.extend(acks)
+            self._updates.extend(updates)
+            return
+        for (_, future), row_id in zip(puts, ids):
+            if not future.done():
+                future.set_result(row_id)
+
+    def _write(self, items: List[QueueItem], acks: List[int],
+               updates: List[QueueItem]) -> List[int]:
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        ids = []
+        self._db.execute("BEGIN")
+        try:
+            for item in items:
+                cursor = self._db.execute(
+                    f"INSERT INTO outbox ({', '.join(COLUMNS)}) "
+                    f"VALUES ({placeholders})",
+                    [getattr(item, column) for column in COLUMNS])
+                ids.append(cursor.lastrowid)
+            if updates:
+                self._db.executemany(
+                    "UPDATE outbox SET text = ?, caption = ? WHERE id = ?",
+                    [(item.text, item.caption, item.id) for item in updates])
+            if acks:
+                self._db.executemany(
+                    "DELETE FROM outbox WHERE id = ?", [(i,) for i in acks])
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return ids
@@ -0,0 +1,399 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import (
+    Any, Awaitable, Callable, Deque, Dict, Optional, Set, Union)
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware, NextRequestMiddlewareType)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMediaGroup, TelegramMethod
+from aiogram.types import Message
+
+from metrics import THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# Методы Bot API, которые расходуют лимит на отправку сообщений
+THROTTLED_PREFIXES = ("send", "copy", "forward", "edit")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def delay(self, units: float, now: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберётся units токенов."""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < units:
+            wait = max(wait, (units - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, units: float):
+        self.tokens -= units
+
+    def block(self, seconds: float, now: float):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+
+
+class SendScheduler:
+    """Глобальное и по-чатовые ведра токенов для исходящих запросов.
+
+    Лимиты Telegram: ~30 сообщений/сек на бота, 20 сообщений/мин в группу
+    и ~1 сообщение/сек в личный чат. Альбом расходует по токену на файл.
+    """
+
+    def __init__(self, global_rate: float = 30.0,
+                 group_per_minute: float = 20.0,
+                 private_rate: float = 1.0,
+                 max_chats: int = 10000):
+        self.group_per_minute = group_per_minute
+        self.private_rate = private_rate
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: "OrderedDict[Union[int, str], TokenBucket]" = (
+            OrderedDict())
+
+    def _bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        if isinstance(chat_id, int) and chat_id > 0:
+            bucket = TokenBucket(self.private_rate, self.private_rate)
+        else:
+            bucket = TokenBucket(self.group_per_minute / 60,
+                                 self.group_per_minute)
+        self._chats[chat_id] = bucket
+        if len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return bucket
+
+    async def acquire(self, chat_id: Union[int, str], units: int = 1):
+        bucket = self._bucket(chat_id)
+        # Альбом больше ёмкости ведра не должен ждать бесконечно
+        units = min(units, bucket.capacity, self._global.capacity)
+        while True:
+            now = time.monotonic()
+            wait = max(self._global.delay(units, now),
+                       bucket.delay(units, now))
+            if wait <= 0:
+                self._global.consume(units)
+                bucket.consume(units)
+                return
+            await asyncio.sleep(wait)
+
+    def penalize(self, chat_id: Union[int, str], seconds: float):
+        # Telegram прислал RetryAfter — ставим чат на паузу для всех
+        self._bucket(chat_id).block(seconds, time.monotonic())
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Пропускает все исходящие отправки через SendScheduler."""
+
+    def __init__(self, scheduler: SendScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request: NextRequestMiddlewareType,
+                       bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not method.__api_method__.startswith(
+                THROTTLED_PREFIXES):
+            return await make_request(bot, method)
+
+        units = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        await self.scheduler.acquire(chat_id, units)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning(
+                f"RetryAfter для {chat_id}: пауза {e.retry_after} сек.")
+            self.scheduler.penalize(chat_id, e.retry_after)
+            raise
+
+
+class InflightLimiter:
+    """Число принятых, но ещё не доставленных сообщений.
+
+    Пока лимит превышен, новые обновления ждут перед обработчиком, и
+    память не растёт вместе с очередью. Лимит мягкий: обработчики,
+    уже прошедшие проверку, добавляют свои сообщения сверх него.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+        self._free: Optional[asyncio.Event] = None
+
+    def add(self, units: int = 1):
+        self.count += units
+
+    def done(self, units: int = 1):
+        self.count = max(0, self.count - units)
+        if self._free is not None and self.count < self.limit:
+            self._free.set()
+
+    async def wait(self) -> bool:
+        # Возвращает True, если пришлось ждать
+        waited = False
+        while self.limit and self.count >= self.limit:
+            if self._free is None:
+                self._free = asyncio.Event()
+            self._free.clear()
+            waited = True
+            await self._free.wait()
+        return waited
+
+
+class SenderState:
+    __slots__ = ("bucket", "noticed_at", "pending", "waiters")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.noticed_at = 0.0
+        self.pending = 0
+        # Обновления сверх max_queued по порядку получения
+        self.waiters: Optional[Deque[asyncio.Future]] = None
+
+
+class SenderQueue:
+    __slots__ = ("lock", "waiting")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class SenderLimitMiddleware(BaseMiddleware):
+    """Ведро токенов на отправителя перед очередью его обновлений.
+
+    Регистрируется внешним middleware на update до SenderOrderMiddleware:
+    решение принимается при получении, и токены принятых, но ещё не
+    обработанных сообщений уже списаны, поэтому задержка учитывает всю
+    очередь отправителя. Если ждать пришлось бы дольше max_delay,
+    сообщение отклоняется, а отправитель получает вежливый ответ (не чаще
+    раза в notice_interval). Сама задержка выдерживается в pace -
+    внутреннем middleware сообщений, уже в очереди отправителя.
+
+    Если у отправителя уже max_queued необработанных сообщений, следующие
+    ничего не теряют: они по порядку ждут места, а пока они ждут, long
+    polling упирается в лимит задач и не забирает новые обновления.
+    """
+
+    def __init__(self, rate: float, burst: float, max_delay: float = 30.0,
+                 inflight: Optional[InflightLimiter] = None,
+                 max_queued: int = 0, max_senders: int = 10000,
+                 notice_interval: float = 30.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.inflight = inflight
+        self.max_queued = max_queued
+        self.max_senders = max_senders
+        self.notice_interval = notice_interval
+        self._senders: "OrderedDict[int, SenderState]" = OrderedDict()
+
+    def configure(self, rate: float, burst: float, max_delay: float,
+                  max_queued: int):
+        # Новые лимиты действуют и для уже известных отправителей
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_queued = max_queued
+        for state in self._senders.values():
+            state.bucket.rate = rate
+            state.bucket.capacity = burst
+            state.bucket.tokens = min(state.bucket.tokens, burst)
+
+    def _state(self, user_id: int) -> SenderState:
+        state = self._senders.get(user_id)
+        if state is not None:
+            self._senders.move_to_end(user_id)
+            return state
+        state = self._senders[user_id] = SenderState(
+            TokenBucket(self.rate, self.burst))
+        if len(self._senders) > self.max_senders:
+            self._senders.popitem(last=False)
+        return state
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        message = getattr(event, "message", None) or getattr(
+            event, "edited_message", None)
+        if user is None or message is None:
+            return await handler(event, data)
+        state = self._state(user.id)
+        if self.max_queued and (state.pending >= self.max_queued
+                                or state.waiters):
+            THROTTLED.inc(action="backpressure")
+            await self._wait_turn(state)
+        else:
+            state.pending += 1
+        try:
+            return await self._limit(handler, event, data, message, state)
+        finally:
+            self._release(state)
+
+    async def _limit(self, handler: Callable[..., Awaitable[Any]],
+                     event: Any, data: Dict[str, Any], message: Message,
+                     state: SenderState) -> Any:
+        now = time.monotonic()
+        if self.rate:
+            wait = state.bucket.delay(1, now)
+            if wait > self.max_delay:
+                THROTTLED.inc(action="rejected")
+                await self._notify(message, state, now)
+                return None
+            # Токен списывается сразу: следующие сообщения встают за этим
+            state.bucket.consume(1)
+            if wait > 0:
+                THROTTLED.inc(action="delayed")
+                data["sender_ready_at"] = now + wait
+        return await handler(event, data)
+
+    async def _wait_turn(self, state: SenderState):
+        if state.waiters is None:
+            state.waiters = deque()
+        turn = asyncio.get_running_loop().create_future()
+        state.waiters.append(turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # Место уже передано этому обновлению - отдаём следующему
+                self._release(state)
+            elif state.waiters and turn in state.waiters:
+                state.waiters.remove(turn)
+            raise
+
+    def _release(self, state: SenderState):
+        # Место освободившегося обновления сразу переходит к первому
+        # ожидающему, чтобы новые обновления не встали перед ним
+        while state.waiters:
+            turn = state.waiters.popleft()
+            if not turn.done():
+                turn.set_result(None)
+                return
+        state.waiters = None
+        state.pending -= 1
+
+    async def pace(self, handler: Callable[..., Awaitable[Any]],
+                   event: Any, data: Dict[str, Any]) -> Any:
+        # Очередь отправителя уже пройдена: ждём его токен и место
+        # в очереди доставки, не обгоняя его же предыдущие сообщения
+        wait = data.get("sender_ready_at", 0.0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.inflight is not None and await self.inflight.wait():
+            THROTTLED.inc(action="backpressure")
+        return await handler(event, data)
+
+    async def _notify(self, message: Message, state: SenderState,
+                      now: float):
+        logger.warning(f"Превышен лимит сообщений от "
+                       f"{message.from_user.id}, сообщение отклонено")
+        if now - state.noticed_at < self.notice_interval:
+            return
+        state.noticed_at = now
+        try:
+            await message.reply("⏳ Слишком много сообщений подряд. "
+                                "Подождите немного и отправьте ещё раз.")
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя: {e}")
+
+
+class SenderOrderMiddleware(BaseMiddleware):
+    """Параллельная обработка обновлений с порядком внутри отправителя.
+
+    Обновления одного отправителя обрабатываются строго по очереди,
+    разных - параллельно, но не больше limit одновременно (0 - без
+    ограничения). Регистрируется внешним middleware на update: задачи
+    обновлений запускаются в порядке получения и встают в очередь
+    отправителя до первого await. track регистрируется первым внешним
+    middleware, и join() ждёт, пока не останется обновлений ни в
+    обработке, ни в очередях, в том числе перед этим middleware.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        # Создаётся при первом обновлении, уже в цикле событий бота:
+        # middleware создаётся при импорте, до asyncio.run
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._senders: Dict[int, SenderQueue] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._idle: Optional[asyncio.Event] = None
+        self.running = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def join(self):
+        if self._tasks:
+            await self._idle.wait()
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def track(self, handler: Callable[..., Awaitable[Any]],
+                    event: Any, data: Dict[str, Any]) -> Any:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+            if not self._tasks:
+                self._idle.set()
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await self._run(handler, event, data)
+        queue = self._senders.get(user.id)
+        if queue is None:
+            queue = self._senders[user.id] = SenderQueue()
+        queue.waiting += 1
+        try:
+            async with queue.lock:
+                return await self._run(handler, event, data)
+        finally:
+            queue.waiting -= 1
+            if not queue.waiting:
+                del self._senders[user.id]
+
+    async def _run(self, handler: Callable[..., Awaitable[Any]],
+                   event: Any, data: Dict[str, Any]) -> Any:
+        # Слот берётся после очереди отправителя: ожидающие своей
+        # очереди обновления не занимают места других отправителей
+        if self.limit and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        self.running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
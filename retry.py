@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from aiogram.exceptions import (
+    TelegramConflictError, TelegramForbiddenError, TelegramMigrateToChat,
+    TelegramNetworkError, TelegramNotFound, TelegramRetryAfter,
+    TelegramServerError, TelegramUnauthorizedError)
+from aiohttp import ClientError
+
+from metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Повтор может помочь
+RETRYABLE = "retryable"
+# Запрос не пройдёт никогда (битый файл, неверные параметры)
+PERMANENT = "permanent"
+# Чат или бот недоступен целиком, повторять бессмысленно до вмешательства
+FATAL = "fatal"
+# Повторы закончились раньше, чем запрос прошёл
+EXHAUSTED = "exhausted"
+
+
+def classify(error: BaseException) -> str:
+    if isinstance(error, (TelegramRetryAfter, TelegramNetworkError,
+                          TelegramServerError, asyncio.TimeoutError,
+                          ClientError, ConnectionError)):
+        return RETRYABLE
+    if isinstance(error, (TelegramForbiddenError, TelegramUnauthorizedError,
+                          TelegramMigrateToChat, TelegramNotFound,
+                          TelegramConflictError)):
+        return FATAL
+    return PERMANENT
+
+
+class RetryError(Exception):
+    """Запрос так и не прошёл; error - последнее исключение."""
+
+    def __init__(self, error: BaseException, kind: str, attempts: int):
+        super().__init__(str(error))
+        self.error = error
+        self.kind = kind
+        self.attempts = attempts
+
+
+class RetryPolicy:
+    """Экспоненциальная пауза с полным джиттером и общим бюджетом времени.
+
+    На RetryAfter пауза равна запрошенной Telegram плюс джиттер, чтобы
+    отложенные отправки не возвращались одновременно.
+    """
+
+    def __init__(self, attempts: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 30.0, budget: float = 120.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def delay(self, attempt: int, error: BaseException) -> float:
+        jitter = random.uniform(0, self.base_delay)
+        if isinstance(error, TelegramRetryAfter):
+            return error.retry_after + jitter
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+async def retry(call: Callable[[], Awaitable[T]], policy: RetryPolicy,
+                description: str = "Отправка") -> T:
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            attempt += 1
+            kind = classify(e)
+            if kind != RETRYABLE:
+                raise RetryError(e, kind, attempt) from e
+            delay = policy.delay(attempt - 1, e)
+            spent = time.monotonic() - started
+            if attempt >= policy.attempts or spent + delay > policy.budget:
+                raise RetryError(e, EXHAUSTED, attempt) from e
+            RETRIES.inc(exception=type(e).__name__)
+            logger.warning(f"{description}: {e}. Попытка {attempt + 1} "
+                           f"через {delay:.1f} сек.")
+            await asyncio.sleep(delay)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+# main.py читает настройки при импорте
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("CHAT_ID", "-1001000000001")
+
+
+def make_items(count, sender_id=1, is_document=False, file_type="photo"):
+    from outbox import QueueItem
+    return [QueueItem(chat_id=sender_id, message_id=number,
+                      sender_id=sender_id, sender_name="Тест",
+                      file_type=file_type, file_id=f"f{number}",
+                      is_document=is_document)
+            for number in range(count)]
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from albums import (
+    AlbumFlushPolicy, BatchScheduler, FixedFlushPolicy, plan_groups)
+from conftest import make_items
+
+
+# AlbumFlushPolicy
+
+def test_flush_policy_starts_with_initial_window():
+    policy = AlbumFlushPolicy(initial_quiet=1.0)
+    assert policy.quiet == 1.0
+
+
+def test_flush_policy_shrinks_for_fast_albums():
+    policy = AlbumFlushPolicy(min_quiet=0.25, initial_quiet=1.0)
+    for _ in range(20):
+        policy.observe(0.01)
+    assert policy.quiet == 0.25
+
+
+def test_flush_policy_grows_for_slow_albums_up_to_max():
+    policy = AlbumFlushPolicy(max_quiet=5.0)
+    policy.observe(0.5)
+    assert policy.quiet == pytest.approx(0.5 + 4 * 0.25)
+    for _ in range(20):
+        policy.observe(60)
+    assert policy.quiet == 5.0
+
+
+def test_flush_policy_caps_delay_by_max_wait():
+    policy = AlbumFlushPolicy(initial_quiet=1.0, max_wait=10.0)
+    assert policy.delay(first_seen=0, now=0) == 1.0
+    assert policy.delay(first_seen=0, now=9.5) == pytest.approx(0.5)
+    assert policy.delay(first_seen=0, now=11) == 0
+
+
+def test_flush_policy_learns_from_late_part():
+    policy = AlbumFlushPolicy(min_quiet=0.25)
+    for _ in range(20):
+        policy.observe(0.01)
+    policy.flushed((1, "g"), last_seen=100.0)
+    assert policy.arrived_late((1, "g"), now=103.0)
+    assert policy.quiet > 1
+    # Каждый отправленный альбом учитывается один раз
+    assert not policy.arrived_late((1, "g"), now=104.0)
+    assert not policy.arrived_late((1, "other"), now=104.0)
+
+
+def test_flush_policy_tracks_limited_number_of_albums():
+    policy = AlbumFlushPolicy(max_tracked=2)
+    for key in ("a", "b", "c"):
+        policy.flushed(key, 0)
+    assert not policy.arrived_late("a", 1)
+    assert policy.arrived_late("c", 1)
+
+
+# BatchScheduler
+
+def test_batch_scheduler_flushes_full_album_at_once():
+    flushed = []
+
+    async def scenario():
+        scheduler = BatchScheduler(FixedFlushPolicy(10, 10), flushed.append,
+                                   group_limit=3)
+        for item in make_items(3):
+            scheduler.add(1, "g", item)
+        assert scheduler.total == 0
+
+    asyncio.run(scenario())
+    assert [len(album) for album in flushed] == [3]
+
+
+def test_batch_scheduler_flushes_after_quiet_period():
+    flushed = []
+
+    async def scenario():
+        scheduler = BatchScheduler(FixedFlushPolicy(0.05, 1), flushed.append)
+        scheduler.start()
+        for item in make_items(2):
+            scheduler.add(1, "g", item)
+        assert not flushed
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert [len(album) for album in flushed] == [2]
+
+
+def test_batch_scheduler_enforces_chat_cap():
+    flushed = []
+
+    async def scenario():
+        scheduler = BatchScheduler(FixedFlushPolicy(10, 10), flushed.append,
+                                   max_per_chat=3)
+        first, second = make_items(2), make_items(2)
+        for item in first:
+            scheduler.add(1, "old", item)
+        for item in second:
+            scheduler.add(1, "new", item)
+        assert flushed == [first]
+        scheduler.flush_all()
+        assert flushed == [first, second]
+        assert scheduler.total == 0
+
+    asyncio.run(scenario())
+
+
+def test_batch_scheduler_moves_deadline_on_new_part():
+    flushed = []
+
+    async def scenario():
+        scheduler = BatchScheduler(FixedFlushPolicy(0.1, 1), flushed.append)
+        scheduler.start()
+        first, second = make_items(2)
+        scheduler.add(1, "g", first)
+        await asyncio.sleep(0.07)
+        scheduler.add(1, "g", second)
+        await asyncio.sleep(0.07)
+        # Старый срок в куче устарел и пропускается
+        assert not flushed
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+        assert len(scheduler._heap) == 0
+
+    asyncio.run(scenario())
+    assert [len(batch) for batch in flushed] == [2]
+
+
+# plan_groups
+
+def test_plan_groups_splits_evenly():
+    items = make_items(11)
+    assert [len(group) for group in plan_groups(items)] == [6, 5]
+
+
+def test_plan_groups_keeps_small_album_whole():
+    items = make_items(10)
+    assert plan_groups(items) == [items]
+
+
+def test_plan_groups_separates_documents():
+    photos = make_items(2)
+    documents = make_items(2, is_document=True, file_type="document")
+    items = [photos[0], documents[0], photos[1], documents[1]]
+    assert plan_groups(items) == [photos, documents]
+
+
+def test_plan_groups_mixes_photos_and_videos():
+    videos = make_items(3, file_type="video")
+    photos = make_items(2)
+    items = [videos[0], photos[0], videos[1], photos[1], videos[2]]
+    assert plan_groups(items) == [items]
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import main
+from dedup import DedupCache
+from outbox import SKIP_ALL, QueueItem
+
+
+def test_lookup_returns_only_chats_that_have_the_file():
+    cache = DedupCache(ttl=60)
+    cache.add(1, "f", 10)
+    cache.add(2, "g", 20)
+    assert cache.lookup([1, 2], "f") == {1: 10}
+    assert cache.lookup([1, 2], "h") == {}
+    cache.add(2, "f", None)
+    assert cache.lookup([1, 2], "f") == {1: 10, 2: 0}
+
+
+def test_entries_expire_and_are_evicted():
+    cache = DedupCache(ttl=60, max_entries=2)
+    cache.add(1, "a", 1)
+    cache.add(1, "b", 2)
+    cache.add(1, "c", 3)
+    assert cache.get(1, "a") is None
+    cache._entries[(1, "b")] = (time.time() - 61, 2)
+    assert cache.get(1, "b") is None
+    assert cache.get(1, "c") == 3
+
+
+def test_pending_counts_each_accepted_copy():
+    cache = DedupCache(ttl=60)
+    cache.mark_pending("f")
+    cache.mark_pending("f")
+    cache.clear_pending("f")
+    assert cache.is_pending("f")
+    cache.clear_pending("f")
+    assert not cache.is_pending("f")
+
+
+def test_entries_survive_restart(tmp_path):
+    path = str(tmp_path / "dedup.sqlite")
+
+    async def write():
+        cache = DedupCache(ttl=60, path=path)
+        cache.open()
+        cache.add(1, "f", 10)
+        await cache.close()
+
+    asyncio.run(write())
+    cache = DedupCache(ttl=60, path=path)
+    cache.open()
+    assert cache.lookup([1, 2], "f") == {1: 10}
+
+
+def test_item_skips_only_listed_chats():
+    item = QueueItem(chat_id=5, message_id=1, sender_id=5, sender_name="a",
+                     skip_chats="-1001,-1002")
+    assert item.skips(-1001)
+    assert not item.skips(-1003)
+    assert not QueueItem(chat_id=5, message_id=1, sender_id=5,
+                         sender_name="a").skips(-1001)
+    item.skip_chats = SKIP_ALL
+    assert item.skips(-1003)
+
+
+def test_send_files_skips_chats_that_already_have_the_file(monkeypatch):
+    sent = []
+
+    async def forward_file(bot, chat_id, item, posted=None):
+        sent.append(chat_id)
+
+    monkeypatch.setattr(main, "forward_file", forward_file)
+    item = QueueItem(chat_id=5, message_id=1, sender_id=5, sender_name="a",
+                     file_type="photo", file_id="x", skip_chats="-1001")
+    for chat_id in (-1001, -1002):
+        asyncio.run(main.send_files(None, chat_id, [item]))
+    assert sent == [-1002]
@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+from forward_index import ForwardIndex
+from outbox import QueueItem
+
+TARGET = main.CHAT_IDS[0]
+
+
+# ForwardIndex
+
+def test_forward_index_keeps_copies_per_target_chat():
+    index = ForwardIndex(max_entries=2)
+    index.add(5, 1, -1001, 10)
+    index.add(5, 1, -1002, 20)
+    assert index.get(5, 1) == {-1001: 10, -1002: 20}
+    assert index.get(5, 2) == {}
+
+
+def test_forward_index_evicts_oldest_source():
+    index = ForwardIndex(max_entries=2)
+    index.add(5, 1, -1001, 10)
+    index.add(5, 2, -1001, 20)
+    index.get(5, 1)
+    index.add(5, 3, -1001, 30)
+    assert index.get(5, 2) == {}
+    assert index.get(5, 1) == {-1001: 10}
+
+
+def test_forward_index_survives_restart(tmp_path):
+    path = str(tmp_path / "forwarded.sqlite")
+
+    async def write():
+        index = ForwardIndex(path=path)
+        index.open()
+        index.add(5, 1, -1001, 10)
+        await index.close()
+
+    asyncio.run(write())
+    index = ForwardIndex(path=path)
+    index.open()
+    assert index.get(5, 1) == {-1001: 10}
+
+
+# handle_edit
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.calls.append(("edit", chat_id, message_id, text))
+
+    async def send_message(self, chat_id, text):
+        self.calls.append(("send", chat_id, text))
+        return SimpleNamespace(message_id=99)
+
+
+def make_edit(text, message_id=1):
+    async def reply(text):
+        pass
+
+    return SimpleNamespace(
+        text=text, caption=None, photo=None, video=None, document=None,
+        chat=SimpleNamespace(id=5), message_id=message_id,
+        from_user=SimpleNamespace(full_name="Тест"), bot=FakeBot(),
+        reply=reply)
+
+
+def run_edit(monkeypatch, msg, before=None):
+    monkeypatch.setattr(main, "forward_index", ForwardIndex())
+    monkeypatch.setattr(main, "queued_items", {})
+    monkeypatch.setattr(main, "sending_items", {})
+
+    async def scenario():
+        monkeypatch.setattr(main, "fanout_semaphore", asyncio.Semaphore(4))
+        if before:
+            await before()
+        await main.handle_edit(msg)
+
+    asyncio.run(scenario())
+    return msg.bot.calls
+
+
+def test_edit_of_queued_message_changes_it_before_sending(monkeypatch):
+    updates = []
+    monkeypatch.setattr(main, "outbox",
+                        SimpleNamespace(update=updates.append))
+    msg = make_edit("новый")
+
+    async def before():
+        item = QueueItem(chat_id=5, message_id=1, sender_id=5,
+                         sender_name="Тест", text="старый")
+        main.queued_items[(5, 1)] = item
+
+    assert run_edit(monkeypatch, msg, before) == []
+    assert [item.text for item in updates] == ["новый"]
+
+
+def test_edit_changes_forwarded_copy(monkeypatch):
+    msg = make_edit("новый")
+
+    async def before():
+        main.forward_index.add(5, 1, TARGET, 10)
+
+    [call] = run_edit(monkeypatch, msg, before)
+    assert call[:3] == ("edit", TARGET, 10)
+    assert "новый" in call[3]
+
+
+def test_edit_without_copy_sends_new_message(monkeypatch):
+    msg = make_edit("новый")
+    [call] = run_edit(monkeypatch, msg)
+    assert call[:2] == ("send", TARGET)
+    assert main.forward_index.get(5, 1) == {TARGET: 99}
+
+
+def test_edit_waits_for_copy_being_sent(monkeypatch):
+    msg = make_edit("новый")
+
+    async def before():
+        sent = asyncio.Event()
+        main.sending_items[(5, 1)] = sent
+
+        def finish():
+            main.forward_index.add(5, 1, TARGET, 10)
+            sent.set()
+
+        asyncio.get_running_loop().call_later(0.05, finish)
+
+    [call] = run_edit(monkeypatch, msg, before)
+    assert call[:3] == ("edit", TARGET, 10)
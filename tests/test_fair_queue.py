@@ -0,0 +1,80 @@
+import asyncio
+
+from fair_queue import FairQueue
+
+
+def run_with_queue(scenario):
+    # Очередь создаёт asyncio.Event: в Python 3.9 - только внутри цикла
+    async def main():
+        queue = FairQueue(lane=lambda job: job[0], sender=lambda job: job[1],
+                          cost=lambda job: job[2])
+        return await scenario(queue)
+
+    return asyncio.run(main())
+
+
+def test_fair_queue_serves_important_lane_first():
+    async def scenario(queue):
+        queue.put_nowait((2, "a", 1))
+        queue.put_nowait((0, "b", 1))
+        assert queue._pop() == (0, "b", 1)
+        assert queue._pop() == (2, "a", 1)
+
+    run_with_queue(scenario)
+
+
+def test_fair_queue_round_robin_between_senders():
+    async def scenario(queue):
+        for number in range(3):
+            queue.put_nowait((0, "a", 1, number))
+        queue.put_nowait((0, "b", 1, 0))
+        order = []
+        while queue.qsize():
+            job = queue._pop()
+            order.append((job[1], job[3]))
+            queue.task_done(job)
+        return order
+
+    assert run_with_queue(scenario) == [
+        ("a", 0), ("b", 0), ("a", 1), ("a", 2)]
+
+
+def test_fair_queue_one_job_per_sender_in_flight():
+    async def scenario(queue):
+        queue.put_nowait((0, "a", 1, 0))
+        queue.put_nowait((0, "a", 1, 1))
+        first = queue._pop()
+        assert queue._pop() is None
+        queue.task_done(first)
+        assert queue._pop() == (0, "a", 1, 1)
+
+    run_with_queue(scenario)
+
+
+def test_fair_queue_charges_by_cost():
+    async def scenario(queue):
+        queue.put_nowait((0, "a", 3))
+        queue.put_nowait((0, "b", 1))
+        assert queue._pop() == (0, "b", 1)
+        assert queue._pop() == (0, "a", 3)
+
+    run_with_queue(scenario)
+
+
+def test_fair_queue_get_waits_for_free_sender_and_join_for_all():
+    async def scenario(queue):
+        queue.put_nowait((0, "a", 1, 0))
+        queue.put_nowait((0, "a", 1, 1))
+        first = await queue.get()
+        second = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        queue.task_done(first)
+        assert await second == (0, "a", 1, 1)
+        join = asyncio.ensure_future(queue.join())
+        await asyncio.sleep(0.01)
+        assert not join.done()
+        queue.task_done(second.result())
+        await asyncio.wait_for(join, 1)
+
+    run_with_queue(scenario)
@@ -0,0 +1,103 @@
+import asyncio
+import os
+
+import pytest
+from conftest import make_items
+
+import main
+from fair_queue import FairQueue
+from rate_limiter import InflightLimiter, SenderLimitMiddleware
+
+
+# reload_settings (SIGHUP)
+
+@pytest.fixture
+def reload_env(monkeypatch):
+    # Перечитывание меняет окружение и глобальные настройки main
+    monkeypatch.setattr(os, "environ", dict(os.environ))
+    for name in ("CHAT_ID", "CHAT_IDS", "MAX_FILE_SIZE", "INFLIGHT_LIMIT",
+                 "SENDER_RATE_PER_MIN", "SENDER_BURST",
+                 "SENDER_MAX_DELAY_SEC", "SENDER_MAX_QUEUED",
+                 "DOTENV_KEYS"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main, "sender_limit",
+                        SenderLimitMiddleware(rate=0, burst=30))
+    monkeypatch.setattr(main, "inflight", InflightLimiter(1000))
+    dotenv = {}
+    monkeypatch.setattr(main, "dotenv_values", lambda: dict(dotenv))
+    return dotenv
+
+
+def test_reload_applies_dotenv_but_not_over_real_environment(reload_env):
+    chat_ids = main.CHAT_IDS
+    reload_env.update(CHAT_ID="-1009", SENDER_RATE_PER_MIN="60",
+                      INFLIGHT_LIMIT="5")
+    main.reload_settings()
+    # CHAT_ID задан в окружении процесса и важнее .env
+    assert main.CHAT_IDS == chat_ids
+    assert main.sender_limit.rate == 1
+    assert main.inflight.limit == 5
+
+
+def test_reload_restores_defaults_of_removed_lines(reload_env):
+    reload_env["SENDER_BURST"] = "5"
+    main.reload_settings()
+    assert main.sender_limit.burst == 5
+    reload_env.clear()
+    main.reload_settings()
+    assert main.sender_limit.burst == 30
+
+
+def test_reload_keeps_previous_settings_on_invalid_value(reload_env):
+    reload_env.update(SENDER_BURST="5", INFLIGHT_LIMIT="много")
+    main.reload_settings()
+    assert main.sender_limit.burst == 30
+    assert main.inflight.limit == 1000
+
+
+# drain (SIGTERM)
+
+def run_drain(monkeypatch, timeout, deliver):
+    delivered = []
+    monkeypatch.setattr(main, "inflight", InflightLimiter(1000))
+
+    async def worker():
+        while True:
+            items = await main.delivery_queue.get()
+            delivered.append(items)
+            main.inflight.done(len(items))
+            main.delivery_queue.task_done(items)
+
+    async def scenario():
+        monkeypatch.setattr(main, "delivery_queue", FairQueue(
+            lane=main.job_lane, sender=lambda items: items[0].sender_id,
+            cost=len))
+        album = make_items(2)
+        for item in album:
+            item.media_group_id = "g"
+            main.album_scheduler.add(item.chat_id, "g", item)
+        main.inflight.add(len(album))
+        task = asyncio.create_task(worker()) if deliver else None
+        started = asyncio.get_running_loop().time()
+        await main.drain(timeout)
+        elapsed = asyncio.get_running_loop().time() - started
+        if task:
+            task.cancel()
+        return album, elapsed
+
+    album, elapsed = asyncio.run(scenario())
+    return album, delivered, elapsed
+
+
+def test_drain_flushes_buffered_album_and_waits_for_delivery(monkeypatch):
+    album, delivered, elapsed = run_drain(monkeypatch, 5, deliver=True)
+    assert delivered == [album]
+    assert main.inflight.count == 0
+    assert elapsed < 1
+
+
+def test_drain_gives_up_after_timeout(monkeypatch):
+    album, delivered, elapsed = run_drain(monkeypatch, 0.1, deliver=False)
+    assert delivered == []
+    assert main.inflight.count == 2
+    assert 0.09 <= elapsed < 1
@@ -0,0 +1,79 @@
+import asyncio
+import sqlite3
+
+import main
+from outbox import Outbox, QueueItem
+
+
+def make_item(message_id, **fields):
+    return QueueItem(chat_id=5, message_id=message_id, sender_id=5,
+                     sender_name="Тест", **fields)
+
+
+def test_unacked_items_are_replayed_after_crash(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+
+    async def accept():
+        outbox = Outbox(path)
+        outbox.open()
+        outbox.start()
+        first = make_item(1, text="привет")
+        await outbox.put(first)
+        await outbox.put(make_item(2, file_type="photo", file_id="f2",
+                                   media_group_id="g"))
+        outbox.ack([first.id])
+        await asyncio.sleep(0.05)
+        # Процесс падает: ни close(), ни доставки
+
+    asyncio.run(accept())
+    outbox = Outbox(path)
+    outbox.open()
+    pending = outbox.pending()
+    assert [(item.message_id, item.file_id, item.media_group_id)
+            for item in pending] == [(2, "f2", "g")]
+
+
+def test_update_changes_pending_text(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+
+    async def scenario():
+        outbox = Outbox(path)
+        outbox.open()
+        outbox.start()
+        item = make_item(1, text="старый")
+        await outbox.put(item)
+        item.text = "новый"
+        outbox.update(item)
+        await outbox.close()
+
+    asyncio.run(scenario())
+    outbox = Outbox(path)
+    outbox.open()
+    assert [item.text for item in outbox.pending()] == ["новый"]
+
+
+def test_open_migrates_first_schema(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "chat_id INTEGER NOT NULL, message_id INTEGER, "
+        "media_group_id TEXT, sender_id INTEGER NOT NULL, "
+        "sender_name TEXT NOT NULL, file_type TEXT, file_id TEXT, "
+        "caption TEXT, is_document INTEGER NOT NULL DEFAULT 0, text TEXT, "
+        "created_at REAL NOT NULL)")
+    db.execute("INSERT INTO outbox (chat_id, sender_id, sender_name, text, "
+               "created_at) VALUES (5, 5, 'Тест', 'привет', 1)")
+    db.commit()
+    db.close()
+    outbox = Outbox(path)
+    outbox.open()
+    [item] = outbox.pending()
+    assert item.text == "привет"
+    assert item.file_unique_id is None
+
+
+def test_pending_jobs_regroups_albums():
+    items = [make_item(1, media_group_id="a"), make_item(2, text="x"),
+             make_item(3, media_group_id="a")]
+    assert main.pending_jobs(items) == [[items[0], items[2]], [items[1]]]
@@ -0,0 +1,271 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe, SendMessage
+
+from rate_limiter import (
+    InflightLimiter, RateLimitMiddleware, SendScheduler,
+    SenderLimitMiddleware, SenderOrderMiddleware, TokenBucket)
+
+
+def make_update(user_id, number):
+    message = SimpleNamespace(from_user=SimpleNamespace(id=user_id),
+                              number=number)
+    return SimpleNamespace(message=message), {
+        "event_from_user": SimpleNamespace(id=user_id)}
+
+
+# TokenBucket, SendScheduler
+
+def test_token_bucket_waits_for_missing_tokens():
+    bucket = TokenBucket(rate=2, capacity=4)
+    now = bucket.updated
+    assert bucket.delay(4, now) == 0
+    bucket.consume(4)
+    assert bucket.delay(1, now) == pytest.approx(0.5)
+    # Пополнение не выше ёмкости
+    assert bucket.delay(4, now + 100) == 0
+    assert bucket.tokens == 4
+
+
+def test_token_bucket_block_overrides_tokens():
+    bucket = TokenBucket(rate=100, capacity=100)
+    now = bucket.updated
+    bucket.block(3, now)
+    assert bucket.delay(1, now) == pytest.approx(3)
+    bucket.block(1, now)
+    assert bucket.delay(1, now) == pytest.approx(3)
+
+
+def test_send_scheduler_picks_bucket_by_chat_type():
+    scheduler = SendScheduler(group_per_minute=20, private_rate=1,
+                              max_chats=2)
+    private = scheduler._bucket(5)
+    group = scheduler._bucket(-1001)
+    assert (private.rate, private.capacity) == (1, 1)
+    assert (group.rate, group.capacity) == (pytest.approx(20 / 60), 20)
+    assert scheduler._bucket(5) is private
+    # Самый давний чат вытесняется
+    scheduler._bucket("@channel")
+    assert list(scheduler._chats) == [5, "@channel"]
+
+
+def test_send_scheduler_large_album_does_not_wait_forever():
+    scheduler = SendScheduler(global_rate=30, group_per_minute=20)
+
+    async def scenario():
+        await asyncio.wait_for(scheduler.acquire(-1001, 50), 1)
+
+    asyncio.run(scenario())
+    assert scheduler._bucket(-1001).tokens == pytest.approx(0, abs=0.1)
+
+
+def test_rate_limit_middleware_pauses_chat_on_retry_after():
+    scheduler = SendScheduler()
+    middleware = RateLimitMiddleware(scheduler)
+    method = SendMessage(chat_id=-1001, text="x")
+
+    async def make_request(bot, method):
+        raise TelegramRetryAfter(method, "flood", 7)
+
+    async def scenario():
+        with pytest.raises(TelegramRetryAfter):
+            await middleware(make_request, None, method)
+
+    asyncio.run(scenario())
+    bucket = scheduler._bucket(-1001)
+    assert bucket.delay(1, bucket.updated) == pytest.approx(7, abs=0.1)
+
+
+def test_rate_limit_middleware_skips_other_methods():
+    scheduler = SendScheduler()
+    middleware = RateLimitMiddleware(scheduler)
+
+    async def make_request(bot, method):
+        return "ok"
+
+    assert asyncio.run(middleware(make_request, None, GetMe())) == "ok"
+    assert not scheduler._chats
+
+
+# SenderLimitMiddleware: ведро отправителя
+
+def make_replying_update(user_id, replies):
+    async def reply(text):
+        replies.append(text)
+
+    event, data = make_update(user_id, 0)
+    event.message.reply = reply
+    return event, data
+
+
+def test_sender_limit_delays_over_burst():
+    seen = []
+
+    async def handler(event, data):
+        seen.append(data.get("sender_ready_at"))
+        return "ok"
+
+    async def scenario():
+        limiter = SenderLimitMiddleware(rate=1, burst=2, max_delay=10)
+        for _ in range(3):
+            assert await limiter(handler, *make_update(1, 0)) == "ok"
+
+    asyncio.run(scenario())
+    assert seen[:2] == [None, None]
+    assert seen[2] is not None
+
+
+def test_sender_limit_rejects_over_max_delay_and_notifies_once():
+    replies = []
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    async def scenario():
+        limiter = SenderLimitMiddleware(rate=0.1, burst=1, max_delay=1)
+        for _ in range(3):
+            await limiter(handler, *make_replying_update(1, replies))
+
+    asyncio.run(scenario())
+    assert len(handled) == 1
+    assert len(replies) == 1
+
+
+def test_sender_limit_configure_applies_to_known_senders():
+    limiter = SenderLimitMiddleware(rate=1, burst=10)
+    state = limiter._state(1)
+    limiter.configure(rate=5, burst=2, max_delay=1, max_queued=0)
+    assert (state.bucket.rate, state.bucket.capacity) == (5, 2)
+    assert state.bucket.tokens == 2
+
+
+def test_pace_waits_for_token_and_inflight_room():
+    order = []
+
+    async def handler(event, data):
+        order.append("handled")
+
+    async def scenario():
+        inflight = InflightLimiter(limit=1)
+        inflight.add()
+        limiter = SenderLimitMiddleware(rate=1, burst=1, inflight=inflight)
+        loop = asyncio.get_running_loop()
+        task = asyncio.create_task(limiter.pace(
+            handler, None, {"sender_ready_at": time.monotonic() + 0.05}))
+        await asyncio.sleep(0.1)
+        assert not order
+        loop.call_soon(inflight.done)
+        await task
+
+    asyncio.run(scenario())
+    assert order == ["handled"]
+
+
+def test_inflight_limiter_without_limit_never_waits():
+    async def scenario():
+        inflight = InflightLimiter(limit=0)
+        inflight.add(100)
+        return await inflight.wait()
+
+    assert asyncio.run(scenario()) is False
+
+
+# SenderLimitMiddleware: очередь отправителя
+
+def test_sender_queue_cap_delays_instead_of_dropping():
+    entered = []
+
+    async def scenario():
+        limiter = SenderLimitMiddleware(rate=0, burst=1, max_queued=2)
+        gate = asyncio.Event()
+
+        async def handler(event, data):
+            entered.append(event.message.number)
+            await gate.wait()
+            return event.message.number
+
+        tasks = [asyncio.create_task(limiter(handler, *make_update(1, n)))
+                 for n in range(5)]
+        await asyncio.sleep(0.01)
+        assert entered == [0, 1]
+        gate.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+    assert entered == [0, 1, 2, 3, 4]
+
+
+def test_sender_queue_cap_survives_cancelled_waiter():
+    entered = []
+
+    async def scenario():
+        limiter = SenderLimitMiddleware(rate=0, burst=1, max_queued=1)
+        gate = asyncio.Event()
+
+        async def handler(event, data):
+            entered.append(event.message.number)
+            await gate.wait()
+
+        tasks = [asyncio.create_task(limiter(handler, *make_update(1, n)))
+                 for n in range(3)]
+        await asyncio.sleep(0.01)
+        tasks[1].cancel()
+        gate.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert limiter._state(1).pending == 0
+
+    asyncio.run(scenario())
+    assert entered == [0, 2]
+
+
+def test_sender_queue_cap_is_per_sender():
+    entered = []
+
+    async def scenario():
+        limiter = SenderLimitMiddleware(rate=0, burst=1, max_queued=1)
+        gate = asyncio.Event()
+
+        async def handler(event, data):
+            entered.append(event.message.from_user.id)
+            await gate.wait()
+
+        tasks = [asyncio.create_task(limiter(handler, *make_update(user, 0)))
+                 for user in (1, 1, 2)]
+        await asyncio.sleep(0.01)
+        assert entered == [1, 2]
+        gate.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+# SenderOrderMiddleware
+
+def test_sender_order_works_in_a_loop_started_after_it():
+    # Middleware создаётся при импорте main.py, до asyncio.run
+    order = SenderOrderMiddleware(limit=1)
+    handled = []
+
+    async def handler(event, data):
+        await asyncio.sleep(0.01)
+        handled.append((data["event_from_user"].id, event.message.number))
+
+    async def scenario():
+        updates = [make_update(user, number)
+                   for number in range(2) for user in (1, 2)]
+        tasks = [asyncio.create_task(order.track(
+            lambda event, data: order(handler, event, data), *update))
+            for update in updates]
+        await asyncio.sleep(0)
+        assert order.pending == 4
+        await asyncio.wait_for(order.join(), 1)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert [n for user, n in handled if user == 1] == [0, 1]
+    assert [n for user, n in handled if user == 2] == [0, 1]
@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+
+import pytest
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter)
+from aiogram.methods import SendMessage
+from aiohttp import ClientConnectionError
+
+import main
+from dead_letters import DeadLetterStore
+from outbox import QueueItem
+from retry import (
+    EXHAUSTED, FATAL, PERMANENT, RETRYABLE, RetryError, RetryPolicy,
+    classify, retry)
+
+METHOD = SendMessage(chat_id=1, text="x")
+
+
+# classify
+
+@pytest.mark.parametrize("error, kind", [
+    (TelegramRetryAfter(METHOD, "flood", 5), RETRYABLE),
+    (TelegramNetworkError(METHOD, "timeout"), RETRYABLE),
+    (asyncio.TimeoutError(), RETRYABLE),
+    (ClientConnectionError(), RETRYABLE),
+    (TelegramForbiddenError(METHOD, "blocked"), FATAL),
+    (TelegramBadRequest(METHOD, "wrong file"), PERMANENT),
+    (ValueError("unexpected"), PERMANENT),
+])
+def test_classify(error, kind):
+    assert classify(error) == kind
+
+
+# retry
+
+def failing(errors, result="ok"):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return call, calls
+
+
+def test_retry_recovers_from_transient_errors():
+    call, calls = failing([ClientConnectionError(), ClientConnectionError()])
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    assert asyncio.run(retry(call, policy)) == "ok"
+    assert len(calls) == 3
+
+
+def test_retry_does_not_repeat_permanent_errors():
+    call, calls = failing([TelegramBadRequest(METHOD, "wrong file")])
+    with pytest.raises(RetryError) as info:
+        asyncio.run(retry(call, RetryPolicy(base_delay=0)))
+    assert (info.value.kind, info.value.attempts) == (PERMANENT, 1)
+    assert len(calls) == 1
+
+
+def test_retry_gives_up_after_attempts():
+    call, calls = failing([ClientConnectionError() for _ in range(5)])
+    with pytest.raises(RetryError) as info:
+        asyncio.run(retry(call, RetryPolicy(attempts=2, base_delay=0)))
+    assert (info.value.kind, info.value.attempts) == (EXHAUSTED, 2)
+
+
+def test_retry_gives_up_when_pause_exceeds_budget():
+    call, calls = failing([TelegramRetryAfter(METHOD, "flood", 60)])
+    with pytest.raises(RetryError) as info:
+        asyncio.run(retry(call, RetryPolicy(base_delay=0, budget=10)))
+    assert info.value.kind == EXHAUSTED
+    assert len(calls) == 1
+
+
+def test_retry_after_delay_is_at_least_requested():
+    policy = RetryPolicy(base_delay=1)
+    delay = policy.delay(0, TelegramRetryAfter(METHOD, "flood", 5))
+    assert 5 <= delay <= 6
+
+
+# Недоставленные
+
+def make_letter_items():
+    return [QueueItem(chat_id=5, message_id=1, sender_id=5,
+                      sender_name="Тест", text="привет")]
+
+
+def test_dead_letter_store_round_trip(tmp_path):
+    store = DeadLetterStore(str(tmp_path / "dead.sqlite"))
+
+    async def add():
+        # Хранилище открывается в цикле: его блокировка - asyncio.Lock
+        store.open()
+        return await store.add(
+            -1001, make_letter_items(), "timeout", EXHAUSTED, 5)
+
+    letter_id = asyncio.run(add())
+    [letter] = store.list()
+    assert (letter.id, letter.chat_id, letter.kind) == (
+        letter_id, -1001, EXHAUSTED)
+    assert letter.items[0].text == "привет"
+    store.remove([letter_id])
+    assert store.list() == []
+
+
+def test_replay_removes_delivered_and_restored_letters(tmp_path,
+                                                       monkeypatch):
+    store = DeadLetterStore(str(tmp_path / "dead.sqlite"))
+
+    async def add():
+        store.open()
+        for chat_id in (-1001, -1002, -1003):
+            await store.add(
+                chat_id, make_letter_items(), "timeout", EXHAUSTED, 5)
+        store.close()
+
+    asyncio.run(add())
+
+    async def send_job(bot, items, chat_ids):
+        [chat_id] = chat_ids
+        if chat_id == -1002:
+            # Снова не прошло и сохранено новой записью
+            await main.dead_letters.add(
+                chat_id, items, "timeout", EXHAUSTED, 5)
+            return {chat_id: "ошибка"}, {}
+        if chat_id == -1003:
+            # Постоянная ошибка: новая запись не создаётся
+            return {chat_id: "ошибка"}, {}
+        return {chat_id: None}, {}
+
+    @contextlib.asynccontextmanager
+    async def make_bot():
+        yield None
+
+    monkeypatch.setattr(main, "dead_letters", store)
+    monkeypatch.setattr(main, "send_job", send_job)
+    monkeypatch.setattr(main, "make_bot", make_bot)
+    asyncio.run(main.dead_letters_cli(["replay"]))
+
+    async def remaining():
+        store.open()
+        return [(letter.id, letter.chat_id) for letter in store.list()]
+
+    assert asyncio.run(remaining()) == [(3, -1003), (4, -1002)]
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from conftest import make_items
+
+import main
+from retry import FATAL, PERMANENT, RetryError
+
+
+def fake_album_api(monkeypatch, broken, kinds=()):
+    # Части с битыми файлами отклоняются с ошибками из kinds по очереди,
+    # затем - с PERMANENT
+    kinds = list(kinds)
+    calls = []
+    dead = []
+
+    async def send_group(bot, chat_id, part, posted=None):
+        calls.append(len(part))
+        if any(item in broken for item in part):
+            kind = kinds.pop(0) if kinds else PERMANENT
+            raise RetryError(ValueError("bad file"), kind, 1)
+
+    async def send_file(bot, chat_id, item, posted=None):
+        calls.append(1)
+        if item in broken:
+            raise RetryError(ValueError("bad file"), PERMANENT, 1)
+
+    async def dead_letter(chat_id, items, error):
+        dead.append(list(items))
+
+    monkeypatch.setattr(main, "send_group", send_group)
+    monkeypatch.setattr(main, "send_file", send_file)
+    monkeypatch.setattr(main, "dead_letter", dead_letter)
+    return calls, dead
+
+
+def test_bisect_album_isolates_broken_file(monkeypatch):
+    items = make_items(8)
+    calls, dead = fake_album_api(monkeypatch, {items[5]})
+    failed = asyncio.run(main.bisect_album(None, 1, items))
+    assert failed == [items[5]]
+    # Исправная половина уходит одной группой
+    assert calls[0] == 4
+    assert dead == [[items[5]]]
+
+
+def test_bisect_album_stops_on_non_permanent_error(monkeypatch):
+    items = make_items(4)
+    calls, dead = fake_album_api(monkeypatch, {items[0]}, [FATAL])
+    with pytest.raises(RetryError):
+        asyncio.run(main.bisect_album(None, 1, items))
+    # Вторая половина не отправляется, весь остаток - в недоставленных
+    assert calls == [2]
+    assert dead == [items[:2], items[2:]]
+
+
+def test_send_album_dead_letters_rest_after_bisect_stops(monkeypatch):
+    items = make_items(12)
+    calls, dead = fake_album_api(
+        monkeypatch, {items[0]}, [PERMANENT, FATAL])
+    text = asyncio.run(main.send_album(None, 1, items))
+    assert text.startswith("❌")
+    # Части по 6: первая отклонена целиком, её половина - с FATAL
+    assert calls == [6, 3]
+    assert dead == [items[:3], items[3:6], items[6:]]
@@ -0,0 +1,33 @@
+import asyncio
+import os
+
+import pytest
+
+from workers import WorkerDied, WorkerPool
+
+
+def double_or_crash(index, jobs, results):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, payload = job
+        if payload == "crash":
+            os._exit(1)
+        results.send((job_id, payload * 2))
+
+
+def test_worker_pool_fails_jobs_of_dead_process_and_respawns():
+    async def scenario():
+        pool = WorkerPool(1, double_or_crash)
+        pool.start()
+        try:
+            assert await asyncio.wait_for(pool.submit(0, 2), 30) == 4
+            with pytest.raises(WorkerDied):
+                await asyncio.wait_for(pool.submit(0, "crash"), 30)
+            assert await asyncio.wait_for(pool.submit(0, 3), 30) == 6
+            assert pool.alive()
+        finally:
+            await pool.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,208 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import signal
+from logging.handlers import QueueHandler, QueueListener
+from typing import (
+    Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set,
+    Tuple)
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerDied(Exception):
+    """Процесс доставки завершился, не выполнив задание."""
+
+
+class WorkerPool:
+    """Процессы доставки, связанные с процессом приёма очередями.
+
+    У каждого процесса своя очередь заданий и свой канал результатов;
+    задания с общим ключом порядка (serve_jobs) выполняются в порядке
+    отправки. Логи процессов пишутся через очередь обработчиками главного
+    процесса.
+
+    Канал результатов закрывается, когда процесс завершается, в том числе
+    аварийно. Если это случилось не при остановке, ожидающие его заданий
+    получают ошибку WorkerDied, а вместо него запускается новый процесс
+    с пустой очередью заданий.
+    """
+
+    def __init__(self, size: int, target: Callable[..., None]):
+        self.size = size
+        self.target = target
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[Optional[multiprocessing.Process]] = []
+        self._queues: List[Any] = []
+        self._pumps: List[Optional[asyncio.Task]] = []
+        self._log_queue: Any = None
+        self._log_listener: Optional[QueueListener] = None
+        # id задания -> (номер процесса, future результата)
+        self._futures: Dict[int, Tuple[int, asyncio.Future]] = {}
+        self._ids = itertools.count(1)
+        self._stopping = False
+
+    def start(self):
+        self._log_queue = self._context.Queue()
+        self._log_listener = QueueListener(
+            self._log_queue, *logging.getLogger().handlers,
+            respect_handler_level=True)
+        self._log_listener.start()
+        self._processes = [None] * self.size
+        self._queues = [None] * self.size
+        self._pumps = [None] * self.size
+        for index in range(self.size):
+            self._spawn(index)
+        logger.info(f"Запущено процессов доставки: {self.size}")
+
+    def _spawn(self, index: int):
+        jobs = self._context.Queue()
+        # У каждого процесса свой канал: упавший процесс не оставит
+        # занятой блокировку общей очереди результатов
+        results, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_entry,
+            args=(self.target, index, jobs, writer, self._log_queue),
+            name=f"delivery-{index}", daemon=True)
+        process.start()
+        # Копия процесса приёма закрывается, чтобы канал закрылся
+        # вместе с процессом доставки
+        writer.close()
+        self._queues[index] = jobs
+        self._processes[index] = process
+        self._pumps[index] = asyncio.create_task(
+            self._pump_results(index, process, results))
+
+    def submit(self, index: int, payload: Any) -> asyncio.Future:
+        job_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[job_id] = (index, future)
+        self._queues[index].put((job_id, payload))
+        return future
+
+    def alive(self) -> bool:
+        return bool(self._processes) and all(
+            process.is_alive() for process in self._processes)
+
+    async def stop(self, timeout: float = 10.0):
+        loop = asyncio.get_running_loop()
+        self._stopping = True
+        for jobs in self._queues:
+            jobs.put(None)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился, "
+                               f"останавливаю принудительно")
+                process.kill()
+        await asyncio.gather(*self._pumps)
+        for _, future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._processes.clear()
+        self._queues.clear()
+        self._pumps.clear()
+        if self._log_listener:
+            self._log_listener.stop()
+            self._log_listener = None
+
+    async def _pump_results(self, index: int,
+                            process: multiprocessing.Process, results: Any):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    job_id, result = await loop.run_in_executor(
+                        None, results.recv)
+                except (EOFError, OSError):
+                    break
+                _, future = self._futures.pop(job_id, (None, None))
+                if future and not future.done():
+                    future.set_result(result)
+        finally:
+            results.close()
+        if self._stopping:
+            return
+        await loop.run_in_executor(None, process.join)
+        if not self._stopping:
+            self._replace(index, process.exitcode)
+
+    def _replace(self, index: int, exitcode: Optional[int]):
+        # Задания, отданные упавшему процессу, уже не выполнятся: их
+        # ожидающие получают ошибку, а новый процесс начинает с пустой
+        # очередью, чтобы не отправить их повторно
+        logger.error(f"Процесс доставки {index} завершился (код "
+                     f"{exitcode}), запускаю заново")
+        error = WorkerDied(f"Процесс доставки {index} завершился "
+                           f"(код {exitcode})")
+        for job_id, (owner, future) in list(self._futures.items()):
+            if owner == index:
+                del self._futures[job_id]
+                if not future.done():
+                    future.set_exception(error)
+        self._queues[index].close()
+        self._spawn(index)
+
+
+def _worker_entry(target: Callable[..., None], index: int, jobs: Any,
+                  results: Any, log_queue: Any):
+    # Сигналы остановки и перезагрузки настроек получает процесс приёма:
+    # он сам дожидается доставки и завершает процессы через очередь
+    for name in ("SIGINT", "SIGTERM", "SIGHUP", "SIGUSR1"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(QueueHandler(log_queue))
+    target(index, jobs, results)
+
+
+async def serve_jobs(jobs: Any, results: Any,
+                     handle: Callable[[Any], Awaitable[Any]],
+                     keys: Callable[[Any], Iterable[Hashable]] = lambda p: (),
+                     limit: int = 0):
+    # Цикл процесса доставки: задания выполняются параллельно, не больше
+    # limit одновременно (0 - без ограничения); задания с общим ключом
+    # из keys(payload) - строго в порядке получения
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit) if limit else None
+    tails: Dict[Hashable, asyncio.Task] = {}
+    running: Set[asyncio.Task] = set()
+
+    async def run(job_id: int, payload: Any, previous: List[asyncio.Task]):
+        if previous:
+            await asyncio.wait(previous)
+        try:
+            if semaphore is None:
+                result = await handle(payload)
+            else:
+                async with semaphore:
+                    result = await handle(payload)
+        except Exception as e:
+            logger.error(f"Ошибка в процессе доставки: {e}")
+            result = None
+        results.send((job_id, result))
+
+    def release(task: asyncio.Task, own: List[Hashable]):
+        running.discard(task)
+        for key in own:
+            if tails.get(key) is task:
+                del tails[key]
+
+    while True:
+        job = await loop.run_in_executor(None, jobs.get)
+        if job is None:
+            break
+        job_id, payload = job
+        own = list(keys(payload))
+        previous = list({tails[key] for key in own if key in tails})
+        task = asyncio.create_task(run(job_id, payload, previous))
+        running.add(task)
+        for key in own:
+            tails[key] = task
+        task.add_done_callback(lambda task, own=own: release(task, own))
+    if running:
+        await asyncio.wait(running)